@@ -8,14 +8,21 @@ import time
 import requests
 import boto3
 import os
+from http.cookiejar import DefaultCookiePolicy
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Cliente DynamoDB para obtener el token
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+# Keep-alive TCP: evita que NATs intermedios cierren la conexión entre invocaciones calientes
+DYNAMODB_CONFIG = Config(region_name='us-east-1', tcp_keepalive=True, max_pool_connections=4)
+dynamodb = boto3.resource('dynamodb', config=DYNAMODB_CONFIG)
 TABLE_NAME = 'cat-test-certification-session-tokens'
+# Handle de tabla creado una vez por contenedor y reutilizado en invocaciones calientes
+tokens_table = dynamodb.Table(TABLE_NAME)
 
 # URL base de la API
 API_BASE_URL = os.environ.get('API_BASE_URL', 'http://vmprocondock.catastrobogota.gov.co:3400/catia-auth')
@@ -25,6 +32,12 @@ MAX_RETRIES = 10
 INITIAL_BACKOFF = 1  # segundos
 MAX_BACKOFF = 60  # segundos
 
+# Sesión HTTP reutilizada entre invocaciones (keep-alive sobre el contenedor caliente)
+_SESSION = requests.Session()
+# Sin cookies: la sesión se comparte entre usuarios y un Set-Cookie no debe viajar a otra invocación
+_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
 def lambda_handler(event, context):
     """
     Obtiene el conteo de predios del usuario autenticado
@@ -46,7 +59,7 @@ def lambda_handler(event, context):
     }
     """
     logger.info("=== Lambda: Contar Predios ===")
-    logger.info(f"Event: {json.dumps(event)}")
+    logger.info("Event: %s", event)
     
     try:
         # Extraer datos del evento - Bedrock Agent envía en requestBody
@@ -55,9 +68,9 @@ def lambda_handler(event, context):
             content = event['requestBody']['content']
             if 'application/json' in content:
                 # Bedrock Agent envía properties como array de objetos
+                # Solo se necesita 'documento': se busca directo, sin armar un dict
                 properties = content['application/json']['properties']
-                body = {prop['name']: prop['value'] for prop in properties}
-                documento = body.get('documento', '')
+                documento = next((prop['value'] for prop in properties if prop['name'] == 'documento'), '')
             else:
                 documento = ''
         else:
@@ -133,7 +146,7 @@ def lambda_handler(event, context):
         if api_response['status_code'] == 200:
             logger.info("API respondió exitosamente con status 200")
             response_data = api_response['data']
-            logger.info(f"Datos de respuesta del API: {json.dumps(response_data)}")
+            logger.info("Datos de respuesta del API: %s", response_data)
             
             response = {
                 "success": response_data.get('success', True),
@@ -142,7 +155,7 @@ def lambda_handler(event, context):
                 "errorCode": response_data.get('errorCode', '')
             }
             
-            logger.info(f"Resultado mapeado: {json.dumps(response)}")
+            logger.info("Resultado mapeado: %s", response)
             logger.info("=== Lambda completado exitosamente ===")
             return format_bedrock_response(event=event, status_code=200, body=response)
         
@@ -285,10 +298,8 @@ def get_token_from_dynamodb(documento):
         return None
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
         logger.info(f"Buscando token en DynamoDB para documento: {documento}")
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' in response:
             token_dict = response['Item']
@@ -336,7 +347,7 @@ def call_contar_predios_api(token):
     logger.info(f"=== Llamando API de Conteo de Predios (con exponential backoff) ===")
     logger.info(f"Endpoint: GET {URL}")
     logger.info(f"Headers: {dict((k, v[:20] + '...' if k == 'Authorization' else v) for k, v in headers.items())}")
-    logger.info(f"Payload: {json.dumps(payload)}")
+    logger.info("Payload: %s", payload)
     logger.info(f"Max reintentos: {MAX_RETRIES}, Backoff inicial: {INITIAL_BACKOFF}s")
     
     last_exception = None
@@ -346,7 +357,7 @@ def call_contar_predios_api(token):
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
             # Timeout de 15 segundos
-            resp = requests.get(URL, json=payload, headers=headers, timeout=15)
+            resp = _SESSION.get(URL, json=payload, headers=headers, timeout=15)
             
             logger.info(f"Respuesta recibida - Status Code: {resp.status_code}")
             logger.info(f"Response headers: {dict(resp.headers)}")
@@ -380,7 +391,7 @@ def call_contar_predios_api(token):
             # Intentar parsear JSON
             try:
                 response_data = resp.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
+                logger.info("Response body parseado exitosamente: %s", response_data)
             except ValueError as json_err:
                 logger.error(f"Respuesta no es JSON: {resp.text[:500]}")
                 logger.error(f"Error al parsear: {str(json_err)}")
@@ -512,14 +523,14 @@ def validate_token(documento):
         try:
             #Llamar al endpoint de validación de token
             logger.info(f"Validando token en intento {attempt + 1}/{MAX_RETRIES}")
-            response = requests.get(VALIDATE_TOKEN_URL, headers=headers, timeout=10)
+            response = _SESSION.get(VALIDATE_TOKEN_URL, headers=headers, timeout=10)
             logger.info(f"Respuesta de validación de token - Status Code: {response.status_code}")
             logger.info(f"Response headers: {dict(response.headers)}")
             logger.info(f"Response content length: {len(response.content)} bytes")
 
             try:
                 response_data = response.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
+                logger.info("Response body parseado exitosamente: %s", response_data)
             except json.JSONDecodeError as json_err:
                 logger.error(f"Respuesta no es JSON: {response.text[:500]}")
                 logger.error(f"Error al parsear: {str(json_err)}")
@@ -745,10 +756,8 @@ def get_refresh_token_from_dynamodb(documento):
         return None
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
         logger.info(f"Buscando refresh token en DynamoDB para documento: {documento[:3]}***")
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' in response:
             refresh_token = response['Item'].get('refreshToken', '')
@@ -810,6 +819,8 @@ def call_refresh_token_api(refresh_token):
     payload = {
         "refreshToken": refresh_token
     }
+    # Serializar una sola vez; los reintentos reutilizan los mismos bytes
+    body_bytes = json.dumps(payload).encode('utf-8')
     
     logger.info(f"=== Llamando API de Refresh Token (con exponential backoff) ===")
     logger.info(f"Endpoint: POST {REFRESH_TOKEN_URL}")
@@ -823,7 +834,7 @@ def call_refresh_token_api(refresh_token):
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
             # Timeout de 15 segundos
-            resp = requests.post(REFRESH_TOKEN_URL, json=payload, headers=headers, timeout=15)
+            resp = _SESSION.post(REFRESH_TOKEN_URL, data=body_bytes, headers=headers, timeout=15)
             
             logger.info(f"Respuesta recibida - Status Code: {resp.status_code}")
             logger.info(f"Response headers: {dict(resp.headers)}")
@@ -855,7 +866,7 @@ def call_refresh_token_api(refresh_token):
             # Intentar parsear JSON
             try:
                 response_data = resp.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
+                logger.info("Response body parseado exitosamente: %s", response_data)
             except ValueError as json_err:
                 logger.error(f"Respuesta no es JSON: {resp.text[:500]}")
                 logger.error(f"Error al parsear: {str(json_err)}")
@@ -976,13 +987,12 @@ def update_token_in_dynamodb(documento, token, refresh_token, token_type='Bearer
         return False
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
-        # TTL: expires_in segundos desde ahora
-        ttl_timestamp = int(time.time()) + expires_in
+        # TTL: expires_in segundos desde ahora (un solo timestamp para updatedAt y ttl)
+        now = int(time.time())
+        ttl_timestamp = now + expires_in
         
         # Actualizar solo los campos del token
-        response = table.update_item(
+        response = tokens_table.update_item(
             Key={'documento': documento},
             UpdateExpression='SET #token = :token, refreshToken = :refreshToken, tokenType = :tokenType, updatedAt = :updatedAt, #ttl = :ttl',
             ExpressionAttributeNames={
@@ -993,7 +1003,7 @@ def update_token_in_dynamodb(documento, token, refresh_token, token_type='Bearer
                 ':token': token,
                 ':refreshToken': refresh_token,
                 ':tokenType': token_type,
-                ':updatedAt': int(time.time()),
+                ':updatedAt': now,
                 ':ttl': ttl_timestamp
             },
             ReturnValues='UPDATED_NEW'
@@ -1025,6 +1035,9 @@ def format_bedrock_response(event, status_code, body):
     """
     logger.info(f"Formateando respuesta para Bedrock Agent - Status: {status_code}")
     
+    # Serializar una sola vez: el mismo string viaja en el body y se registra en el log
+    body_json = json.dumps(body, ensure_ascii=False)
+    
     formatted_response = {
         "messageVersion": "1.0",
         "response": {
@@ -1034,11 +1047,11 @@ def format_bedrock_response(event, status_code, body):
             "httpStatusCode": status_code,
             "responseBody": {
                 "application/json": {
-                    "body": json.dumps(body, ensure_ascii=False)
+                    "body": body_json
                 }
             }
         }
     }
     
-    logger.info(f"Respuesta formateada: {json.dumps(formatted_response, ensure_ascii=False)}")
+    logger.info("Respuesta formateada: %s", body_json)
     return formatted_response
\ No newline at end of file
@@ -13,16 +13,25 @@ import time
 import random
 import os
 from datetime import datetime
+from http.cookiejar import DefaultCookiePolicy
+from types import MappingProxyType
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Clientes AWS
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+# Keep-alive TCP: evita que NATs intermedios cierren la conexión entre invocaciones calientes
+DYNAMODB_CONFIG = Config(region_name='us-east-1', tcp_keepalive=True, max_pool_connections=4)
+dynamodb = boto3.resource('dynamodb', config=DYNAMODB_CONFIG)
 TABLE_TOKENS = 'cat-test-certification-session-tokens'
 MOCK_USERS_TABLE = 'cat-test-mock-users'
 TABLE_AUDITORIA = 'cat-test-certification-data'
+# Handles de tabla creados una vez por contenedor y reutilizados en invocaciones calientes
+tokens_table = dynamodb.Table(TABLE_TOKENS)
+mock_users_table = dynamodb.Table(MOCK_USERS_TABLE)
 
 # Base URL de la API
 API_BASE_URL = "http://vmprocondock.catastrobogota.gov.co:3400/catia-auth"
@@ -32,12 +41,19 @@ MAX_RETRIES = 10
 INITIAL_BACKOFF = 1  # segundos
 MAX_BACKOFF = 60  # segundos
 
+# Sesión HTTP reutilizada entre invocaciones (keep-alive sobre el contenedor caliente)
+_SESSION = requests.Session()
+# Sin cookies: la sesión se comparte entre usuarios y un Set-Cookie no debe viajar a otra invocación
+_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
 # Límite de certificados por solicitud
 MAX_CERTIFICADOS = 3
 
 MOCK_USERS_TABLE = 'cat-test-mock-users'
 ENABLE_MOCK = os.environ.get('ENABLE_MOCK', 'false').lower() == 'true'
-MOCK_USERS = {
+# Vista de solo lectura: los datos mock no deben mutarse entre invocaciones
+MOCK_USERS = MappingProxyType({
     "123456789": {
         "nombre": "Juan Carlos",
         "apellido": "Rodríguez",
@@ -50,7 +66,7 @@ MOCK_USERS = {
         "email": "maria.gonzalez@catastro.test",
         "prediosCount": 15
     }
-}
+})
 
 logger.info(f"[MOCK CONFIG] ENABLE_MOCK = {ENABLE_MOCK}")
 if ENABLE_MOCK:
@@ -86,8 +102,8 @@ def get_mock_session_data(documento):
     logger.info("[MOCK] 🎭 Generando datos de sesión mock")
     logger.info(f"[MOCK] Documento: {documento[:3]}***")
     
-    if documento in MOCK_USERS:
-        user_data = MOCK_USERS[documento]
+    user_data = MOCK_USERS.get(documento)
+    if user_data is not None:
         
         # CHIPs simulados según el usuario
         if documento == "123456789":
@@ -210,9 +226,7 @@ def delete_mock_chips_seleccionados(documento):
     """
     logger.info(f"[MOCK] 🎭 Eliminando chips seleccionados para documento: {documento[:3]}***")
     try:
-        dynamo_mock_table = dynamodb.Table(MOCK_USERS_TABLE)
-
-        response = dynamo_mock_table.update_item(
+        response = mock_users_table.update_item(
             Key={'documento': documento},
             UpdateExpression="REMOVE chipsSeleccionados",
             ReturnValues="UPDATED_NEW"
@@ -230,9 +244,7 @@ def delete_chips_seleccionados(documento):
     """
     logger.info(f" Limpiando chips seleccionados en DynamoDB para documento: {documento[:3]}***")
     try:
-        table = dynamodb.Table(TABLE_TOKENS)
-
-        response = table.update_item(
+        response = tokens_table.update_item(
             Key={'documento': documento},
             UpdateExpression="REMOVE chipsSeleccionados",
             ReturnValues="UPDATED_NEW"
@@ -265,9 +277,7 @@ def get_mock_certificado_response(documento,chip):
     logger.info(f"[MOCK] Request Number: {request_number}")
 
     try:
-        dynamo_mock_table = dynamodb.Table(MOCK_USERS_TABLE)
-
-        response = dynamo_mock_table.get_item(Key={'documento': documento})
+        response = mock_users_table.get_item(Key={'documento': documento})
         mock_user = response.get('Item', None)
         email = mock_user.get('correo', '') if mock_user else ''
         if email:
@@ -355,7 +365,7 @@ def handler(event, context):
     }
     """
     logger.info("=== Lambda: Generar Certificados ===")
-    logger.info(f" Event recibido: {json.dumps(event, ensure_ascii=False)}")
+    logger.info(" Event recibido: %s", event)
     
     # Extraer parámetros - Bedrock Agent envía en requestBody
     if 'requestBody' in event and 'content' in event['requestBody']:
@@ -821,9 +831,7 @@ def get_session_data_from_dynamodb(documento):
     logger.info(f"  - Documento (PK): {documento[:3]}*** (longitud: {len(documento)})")
     
     try:
-        table = dynamodb.Table(TABLE_TOKENS)
-        
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' not in response:
             logger.warning(f" No se encontró sesión en DynamoDB")
@@ -880,9 +888,7 @@ def obtener_chips_seleccionados_desde_dynamo(documento):
     logger.info(f"  - Documento (PK): {documento[:3]}*** (longitud: {len(documento)})")
     
     try:
-        table = dynamodb.Table(TABLE_TOKENS)
-        
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' not in response:
             logger.warning(f" No se encontró registro en DynamoDB")
@@ -928,9 +934,8 @@ def obtener_chips_seleccionados_desde_dynamo_mock(documento):
         logger.info(f"  - Tabla: {MOCK_USERS_TABLE}")
         logger.info(f"  - Documento (PK): {documento[:3]}***")
 
-        table = dynamodb.Table(MOCK_USERS_TABLE)
         
-        response = table.get_item(Key={'documento': documento})
+        response = mock_users_table.get_item(Key={'documento': documento})
         
         if 'Item' not in response:
             logger.warning(f" No se encontró registro en DynamoDB")
@@ -1025,7 +1030,7 @@ def obtener_chip_por_direccion(token, direccion):
         try:
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
-            resp = requests.get(URL, headers=headers, timeout=15)
+            resp = _SESSION.get(URL, headers=headers, timeout=15)
             
             logger.info(f" Respuesta recibida:")
             logger.info(f"  - Status Code: {resp.status_code}")
@@ -1113,7 +1118,7 @@ def obtener_chip_por_direccion(token, direccion):
             
             else:
                 logger.error(f" Status {resp.status_code} - Error inesperado")
-                logger.error(f"  - Response completo: {json.dumps(response_data, ensure_ascii=False)[:500]}")
+                logger.error("  - Response completo: %.500s", response_data)
                 mensaje_error = response_data.get('message', f'Error en el servidor (status {resp.status_code})')
                 return {
                     "success": False,
@@ -1222,7 +1227,7 @@ def generar_certificado(token, chip):
         try:
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
-            resp = requests.get(URL, headers=headers, timeout=30)  # Mayor timeout para generación
+            resp = _SESSION.get(URL, headers=headers, timeout=30)  # Mayor timeout para generación
             
             logger.info(f" Respuesta recibida:")
             logger.info(f"  - Status Code: {resp.status_code}")
@@ -1392,23 +1397,32 @@ def guardar_auditoria(documento, tipo_documento, nombre_completo, chip, request_
     logger.info(f"  - Tabla: {TABLE_AUDITORIA}")
     
     try:
-        table = dynamodb.Table(TABLE_AUDITORIA)
-        
         # Generar ID único
         audit_id = str(uuid.uuid4())
         
         # Timestamp actual en formato ISO 8601
         fecha_hora = datetime.utcnow().isoformat() + 'Z'
         
-        # Item de auditoría
+        # Los valores del body pueden llegar como null o numéricos (tipoDocumento: null, chip
+        # numérico); el atributo tipado {'S': ...} exige str, así que se normalizan aquí
+        documento, tipo_documento, nombre_completo, chip = (
+            '' if valor is None else str(valor)
+            for valor in (documento, tipo_documento, nombre_completo, chip)
+        )
+        if request_number is None:
+            request_number = ''
+        
+        # Item de auditoría con atributos ya tipados: el put_item del cliente de bajo
+        # nivel evita el TypeSerializer del recurso en cada escritura
         item = {
-            'id': audit_id,  # PK
-            'nombreCompleto': nombre_completo,
-            'tipoDocumento': tipo_documento,
-            'numeroIdentificacion': documento,
-            'fechaHora': fecha_hora,
-            'numeroRadicado': request_number,
-            'chip': chip  # Campo adicional para referencia
+            'id': {'S': audit_id},  # PK
+            'nombreCompleto': {'S': nombre_completo},
+            'tipoDocumento': {'S': tipo_documento},
+            'numeroIdentificacion': {'S': documento},
+            'fechaHora': {'S': fecha_hora},
+            # El API puede devolver el radicado como número; se conserva su tipo
+            'numeroRadicado': {'N': str(request_number)} if isinstance(request_number, int) else {'S': str(request_number)},
+            'chip': {'S': chip}  # Campo adicional para referencia
         }
         
         logger.info(f"  - ID: {audit_id}")
@@ -1419,7 +1433,7 @@ def guardar_auditoria(documento, tipo_documento, nombre_completo, chip, request_
         logger.info(f"  - Fecha/Hora: {fecha_hora}")
         
         # Guardar en DynamoDB
-        table.put_item(Item=item)
+        dynamodb.meta.client.put_item(TableName=TABLE_AUDITORIA, Item=item)
         
         logger.info(f" Auditoría guardada exitosamente")
         logger.info(f"  - ID de auditoría: {audit_id}")
@@ -1455,7 +1469,9 @@ def build_response(event, response_data, status_code=200):
     logger.info(f" Construyendo respuesta para Bedrock Agent:")
     logger.info(f"  - Status Code: {status_code}")
     logger.info(f"  - Action Group: {event.get('actionGroup', 'GenerarCertificados')}")
-    logger.info(f"  - Response Body (preview): {json.dumps(response_data, ensure_ascii=False)[:200]}...")
+    # Serializar una sola vez: el preview del log es un corte del mismo string
+    body_json = json.dumps(response_data, ensure_ascii=False)
+    logger.info("  - Response Body (preview): %.200s...", body_json)
     
     formatted_response = {
         "messageVersion": "1.0",
@@ -1466,7 +1482,7 @@ def build_response(event, response_data, status_code=200):
             "httpStatusCode": status_code,
             "responseBody": {
                 "application/json": {
-                    "body": json.dumps(response_data, ensure_ascii=False)
+                    "body": body_json
                 }
             }
         }
@@ -9,14 +9,21 @@ import logging
 import requests
 import boto3
 import time
+from http.cookiejar import DefaultCookiePolicy
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Cliente DynamoDB
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+# Keep-alive TCP: evita que NATs intermedios cierren la conexión entre invocaciones calientes
+DYNAMODB_CONFIG = Config(region_name='us-east-1', tcp_keepalive=True, max_pool_connections=4)
+dynamodb = boto3.resource('dynamodb', config=DYNAMODB_CONFIG)
 TABLE_NAME = 'cat-test-certification-session-tokens'
+# Handle de tabla creado una vez por contenedor y reutilizado en invocaciones calientes
+tokens_table = dynamodb.Table(TABLE_NAME)
 
 # Base URL de la API
 API_BASE_URL = "http://vmprocondock.catastrobogota.gov.co:3400/catia-auth"
@@ -26,6 +33,12 @@ MAX_RETRIES = 10
 INITIAL_BACKOFF = 1  # segundos
 MAX_BACKOFF = 60  # segundos
 
+# Sesión HTTP reutilizada entre invocaciones (keep-alive sobre el contenedor caliente)
+_SESSION = requests.Session()
+# Sin cookies: la sesión se comparte entre usuarios y un Set-Cookie no debe viajar a otra invocación
+_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
 
 def calculate_backoff(attempt):
     """
@@ -73,7 +86,7 @@ def handler(event, context):
     }
     """
     logger.info("=== Lambda: Listar Predios ===")
-    logger.info(f" Event recibido: {json.dumps(event, ensure_ascii=False)}")
+    logger.info(" Event recibido: %s", event)
     
     # Extraer parámetros - Bedrock Agent envía en requestBody
     if 'requestBody' in event and 'content' in event['requestBody']:
@@ -256,7 +269,7 @@ def listar_predios_api(token):
         try:
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
-            resp = requests.get(URL, headers=headers, timeout=15)
+            resp = _SESSION.get(URL, headers=headers, timeout=15)
             
             logger.info(f" Respuesta recibida:")
             logger.info(f"  - Status Code: {resp.status_code}")
@@ -449,7 +462,10 @@ def build_response(event, response_data, status_code=200):
     preview_data = response_data.copy()
     if 'predios' in preview_data and isinstance(preview_data['predios'], list) and len(preview_data['predios']) > 2:
         preview_data['predios'] = f"[{len(preview_data['predios'])} predios]"
-    logger.info(f"  - Response Body (preview): {json.dumps(preview_data, ensure_ascii=False)[:200]}...")
+    logger.info("  - Response Body (preview): %.200s...", preview_data)
+    
+    # El body se serializa una sola vez, aparte del preview
+    body_json = json.dumps(response_data, ensure_ascii=False)
     
     formatted_response = {
         "messageVersion": "1.0",
@@ -460,7 +476,7 @@ def build_response(event, response_data, status_code=200):
             "httpStatusCode": status_code,
             "responseBody": {
                 "application/json": {
-                    "body": json.dumps(response_data, ensure_ascii=False)
+                    "body": body_json
                 }
             }
         }
@@ -485,10 +501,8 @@ def get_token_from_dynamodb(documento):
         return None
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
         logger.info(f"Buscando token en DynamoDB para documento: {documento}")
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' in response:
             token_dict = response['Item']
@@ -540,14 +554,14 @@ def validate_token(documento):
         try:
             #Llamar al endpoint de validación de token
             logger.info(f"Validando token en intento {attempt + 1}/{MAX_RETRIES}")
-            response = requests.get(VALIDATE_TOKEN_URL, headers=headers, timeout=10)
+            response = _SESSION.get(VALIDATE_TOKEN_URL, headers=headers, timeout=10)
             logger.info(f"Respuesta de validación de token - Status Code: {response.status_code}")
             logger.info(f"Response headers: {dict(response.headers)}")
             logger.info(f"Response content length: {len(response.content)} bytes")
 
             try:
                 response_data = response.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
+                logger.info("Response body parseado exitosamente: %s", response_data)
             except json.JSONDecodeError as json_err:
                 logger.error(f"Respuesta no es JSON: {response.text[:500]}")
                 logger.error(f"Error al parsear: {str(json_err)}")
@@ -772,10 +786,8 @@ def get_refresh_token_from_dynamodb(documento):
         return None
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
         logger.info(f"Buscando refresh token en DynamoDB para documento: {documento[:3]}***")
-        response = table.get_item(Key={'documento': documento})
+        response = tokens_table.get_item(Key={'documento': documento})
         
         if 'Item' in response:
             refresh_token = response['Item'].get('refreshToken', '')
@@ -837,6 +849,8 @@ def call_refresh_token_api(refresh_token):
     payload = {
         "refreshToken": refresh_token
     }
+    # Serializar una sola vez; los reintentos reutilizan los mismos bytes
+    body_bytes = json.dumps(payload).encode('utf-8')
     
     logger.info(f"=== Llamando API de Refresh Token (con exponential backoff) ===")
     logger.info(f"Endpoint: POST {REFRESH_TOKEN_URL}")
@@ -850,7 +864,7 @@ def call_refresh_token_api(refresh_token):
             logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
             
             # Timeout de 15 segundos
-            resp = requests.post(REFRESH_TOKEN_URL, json=payload, headers=headers, timeout=15)
+            resp = _SESSION.post(REFRESH_TOKEN_URL, data=body_bytes, headers=headers, timeout=15)
             
             logger.info(f"Respuesta recibida - Status Code: {resp.status_code}")
             logger.info(f"Response headers: {dict(resp.headers)}")
@@ -882,7 +896,7 @@ def call_refresh_token_api(refresh_token):
             # Intentar parsear JSON
             try:
                 response_data = resp.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
+                logger.info("Response body parseado exitosamente: %s", response_data)
             except ValueError as json_err:
                 logger.error(f"Respuesta no es JSON: {resp.text[:500]}")
                 logger.error(f"Error al parsear: {str(json_err)}")
@@ -1003,13 +1017,12 @@ def update_token_in_dynamodb(documento, token, refresh_token, token_type='Bearer
         return False
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
-        # TTL: expires_in segundos desde ahora
-        ttl_timestamp = int(time.time()) + expires_in
+        # TTL: expires_in segundos desde ahora (un solo timestamp para updatedAt y ttl)
+        now = int(time.time())
+        ttl_timestamp = now + expires_in
         
         # Actualizar solo los campos del token
-        response = table.update_item(
+        response = tokens_table.update_item(
             Key={'documento': documento},
             UpdateExpression='SET #token = :token, refreshToken = :refreshToken, tokenType = :tokenType, updatedAt = :updatedAt, #ttl = :ttl',
             ExpressionAttributeNames={
@@ -1020,7 +1033,7 @@ def update_token_in_dynamodb(documento, token, refresh_token, token_type='Bearer
                 ':token': token,
                 ':refreshToken': refresh_token,
                 ':tokenType': token_type,
-                ':updatedAt': int(time.time()),
+                ':updatedAt': now,
                 ':ttl': ttl_timestamp
             },
             ReturnValues='UPDATED_NEW'
@@ -1052,6 +1065,9 @@ def format_bedrock_response(event, status_code, body):
     """
     logger.info(f"Formateando respuesta para Bedrock Agent - Status: {status_code}")
     
+    # Serializar una sola vez: el mismo string viaja en el body y se registra en el log
+    body_json = json.dumps(body, ensure_ascii=False)
+    
     formatted_response = {
         "messageVersion": "1.0",
         "response": {
@@ -1061,11 +1077,11 @@ def format_bedrock_response(event, status_code, body):
             "httpStatusCode": status_code,
             "responseBody": {
                 "application/json": {
-                    "body": json.dumps(body, ensure_ascii=False)
+                    "body": body_json
                 }
             }
         }
     }
     
-    logger.info(f"Respuesta formateada: {json.dumps(formatted_response, ensure_ascii=False)}")
+    logger.info("Respuesta formateada: %s", body_json)
     return formatted_response
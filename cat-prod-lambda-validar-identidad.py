@@ -1,9 +1,11 @@
 import json
 import os
-import requests
 import logging
 import time
+import random
+from http.cookiejar import DefaultCookiePolicy
 import boto3
+from botocore.config import Config
 from typing import Dict, Any
 
 # Configure logging
@@ -14,34 +16,31 @@ logger.setLevel(logging.INFO)
 API_BASE_URL = os.environ.get('API_BASE_URL', 'http://vmprocondock.catastrobogota.gov.co:3400/catia-auth')
 API_KEY = os.environ.get('API_KEY', '')
 
+# URL y headers del API de validación (constantes por contenedor)
+_URL = f"{API_BASE_URL}/auth/temp-key"
+_HEADERS = {'Content-Type': 'application/json'}
+if API_KEY:
+    _HEADERS['Authorization'] = f'Bearer {API_KEY}'
+else:
+    logger.warning("No se encontró API_KEY en las variables de entorno")
+
+# Sesión HTTP reutilizada entre invocaciones (keep-alive sobre el contenedor caliente).
+# Se crea en el primer uso: con ENABLE_MOCK (default) requests nunca se importa
+_SESSION = None
+
 MAX_RETRIES = 8
 INITIAL_BACKOFF = 1  # segundos
 MAX_BACKOFF = 60  # segundos
 
 MOCK_TABLE = "cat-test-mock-users"
-MOCK_USERS = {
-    "135791113": {
-        "success": True,
-        "message": "Clave temporal enviada exitosamente",
-        "data": {
-            "mensaje": "Clave temporal enviada exitosamente",
-            "emailOfuscado": "j***@blend360.com",
-            "tiempoExpiracion": 5
-        },
-    "timestamp": "2025-11-20T13:31:16.768Z"
-    },
-    "24681012": {
-        "success": True,
-        "message": "Clave temporal enviada exitosamente",
-        "data": {
-            "mensaje": "Clave temporal enviada exitosamente",
-            "emailOfuscado": "j***@blend360.com",
-            "tiempoExpiracion": 5
-        },
-    "timestamp": "2025-11-20T13:31:16.768Z"
-    },
-    }
+# Recurso y tabla DynamoDB creados una vez por contenedor, no en cada respuesta mock.
+# Keep-alive TCP: evita que NATs intermedios cierren la conexión entre invocaciones calientes
+DYNAMODB_CONFIG = Config(region_name='us-east-1', tcp_keepalive=True, max_pool_connections=4)
+dynamodb = boto3.resource('dynamodb', config=DYNAMODB_CONFIG)
+mock_table = dynamodb.Table(MOCK_TABLE)
 ENABLE_MOCK = os.environ.get('ENABLE_MOCK', 'true').lower() == 'true'
+# Simulated API latency in MOCK mode (max seconds, 0 = disabled)
+MOCK_LATENCY_MAX = float(os.environ.get('MOCK_LATENCY_MAX', '0'))
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -55,13 +54,18 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Returns:
         Response formatted for Bedrock Agent
     """
-    logger.info("=== Iniciando Lambda - Validar Identidad ===")
-    logger.info(f"API_BASE_URL: {API_BASE_URL}")
-    logger.info(f"Event recibido: {json.dumps(event)}")
+    logger.info("=== Iniciando Lambda - Validar Identidad === API_BASE_URL: %s, Event recibido: %s",
+                API_BASE_URL, event)
+    
+    # Metadatos del sobre de respuesta, extraídos una sola vez por invocación
+    envelope_meta = {
+        'actionGroup': event.get('actionGroup', ''),
+        'apiPath': event.get('apiPath', ''),
+        'httpMethod': event.get('httpMethod', '')
+    }
     
     try:
         # Extract parameters from Bedrock Agent event
-        logger.info("Extrayendo parámetros del evento de Bedrock Agent")
         request_body = event.get('requestBody', {})
         content = request_body.get('content', {})
         application_json = content.get('application/json', {})
@@ -71,14 +75,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         documento = None
         tipo_documento = None
         
+        # Una sola pasada sin dict intermedio; el nombre se lee una vez por propiedad
         for prop in properties:
-            if prop.get('name') == 'documento':
+            name = prop.get('name')
+            if name == 'documento':
                 documento = prop.get('value')
-            elif prop.get('name') == 'tipoDocumento':
+            elif name == 'tipoDocumento':
                 tipo_documento = prop.get('value')
         
-        logger.info(f"Parámetros extraídos - Tipo: {tipo_documento}, Documento: {documento}")
-        
         # Validate required parameters
         if not documento or not tipo_documento:
             logger.error("Validación fallida: Parámetros requeridos faltantes")
@@ -89,14 +93,14 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     "message": "Parámetros requeridos faltantes: documento y tipoDocumento",
                     "errorCode": "MISSING_REQUIRED_PARAMS"
                 },
-                event=event
+                envelope_meta=envelope_meta
             )
         
-        logger.info("Parámetros validados correctamente")
+        # Un solo registro por invocación con los parámetros ya validados
+        logger.info("Parámetros validados - Tipo: %s, Documento: %s***, mock: %s",
+                    tipo_documento, documento[:3], ENABLE_MOCK)
         
         # Call external API
-        logger.info("Iniciando llamada al API externo")
-        
         # Check if mock mode is enabled
         if ENABLE_MOCK:
             logger.warning("🎭 MOCK MODE ENABLED - Using test data instead of real API")
@@ -108,7 +112,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if api_response['status_code'] == 200:
             logger.info("API respondió exitosamente con status 200")
             response_data = api_response['data']
-            logger.info(f"Datos de respuesta del API: {json.dumps(response_data)}")
+            logger.info("Datos de respuesta del API: %s", response_data)
             
             # Map API response to expected schema
             validation_result = {
@@ -118,25 +122,30 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 "correo": "",  # Not provided by API
             }
             
-            logger.info(f"Resultado de validación mapeado: {json.dumps(validation_result)}")
+            logger.info("Resultado de validación mapeado: %s", validation_result)
             logger.info("=== Lambda completado exitosamente ===")
             
             return format_bedrock_response(
                 status_code=200,
                 body=validation_result,
-                event=event
+                envelope_meta=envelope_meta
             )
         else:
             # Handle API errors
             response_data = api_response.get('data', {})
-            logger.error(f"API respondió con error - Status: {api_response['status_code']}, Error: {response_data.get('message', 'Error desconocido')}")
+            logger.error(
+                "API respondió con error - Status: %s, Code: %s, Error: %s",
+                api_response['status_code'],
+                response_data.get('errorCode'),
+                response_data.get('message', 'Error desconocido')
+            )
             return format_bedrock_response(
                 status_code=200,
                 body={
                     "valido": False,
                     "mensaje": f"Error en la validación: {response_data.get('message', 'Error desconocido')}"
                 },
-                event=event
+                envelope_meta=envelope_meta
             )
     
     except Exception as e:
@@ -150,10 +159,26 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 "message": "Ocurrió un error inesperado. Por favor, intenta nuevamente.",
                 "errorCode": "INTERNAL_SERVER_ERROR"
             },
-            event=event
+            envelope_meta=envelope_meta
         )
 
 
+def get_http_session():
+    """
+    Retorna la sesión HTTP del contenedor, importando requests y creándola en el primer uso
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _SESSION = requests.Session()
+        # Sin cookies: la sesión se comparte entre usuarios y un Set-Cookie no debe viajar a otra invocación
+        _SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        _SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=0))
+        _SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=0))
+    return _SESSION
+
+
 def call_identity_validation_api(tipo_documento: str, numero_documento: str) -> Dict[str, Any]:
     """
     Call the identity validation API
@@ -166,50 +191,41 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
     Returns:
         Dictionary with status_code, data, and optional error
     """
-    logger.info(f"=== Llamando API de validación (con exponential backoff) ===")
-    
-    url = f"{API_BASE_URL}/auth/temp-key"
+    import requests  # diferido: solo se carga cuando se llama al API real
     
+    session = get_http_session()
     payload = {
         "tipoDocumento": tipo_documento,
         "numeroDocumento": numero_documento,
         "validInput": True
     }
     
-    logger.info(f"URL completa: {url}")
-    logger.info(f"Payload a enviar: {json.dumps(payload)}")
-    logger.info(f"Max reintentos: {MAX_RETRIES}, Backoff inicial: {INITIAL_BACKOFF}s")
+    # Serializar una sola vez; los reintentos reutilizan los mismos bytes
+    body = json.dumps(payload)
+    body_bytes = body.encode('utf-8')
     
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    
-    # Add API key if available
-    if API_KEY:
-        headers['Authorization'] = f'Bearer {API_KEY}'
-        logger.info("API Key agregado al header de autorización")
-    else:
-        logger.warning("No se encontró API_KEY en las variables de entorno")
-    
-    last_exception = None
+    logger.info("=== Llamando API de validación: POST %s, payload %s, max reintentos %s, backoff inicial %ss ===",
+                _URL, body, MAX_RETRIES, INITIAL_BACKOFF)
     
     for attempt in range(MAX_RETRIES):
         try:
-            logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
-            logger.info("Enviando petición POST al API")
+            logger.info("--- Intento %s/%s: enviando petición POST al API ---", attempt + 1, MAX_RETRIES)
             
             # Make HTTP request
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=30
+            response = session.post(
+                _URL,
+                data=body_bytes,
+                headers=_HEADERS,
+                timeout=(3, 30)
             )
             
-            logger.info(f"Respuesta recibida - Status Code: {response.status_code}")
-            logger.info(f"Response headers: {dict(response.headers)}")
-            logger.info(f"Response content length: {len(response.content)} bytes")
-            logger.info(f"Response raw content: {response.text[:500]}")  # Log first 500 chars
+            content_type = response.headers.get('Content-Type', '')
+            logger.info("Respuesta recibida - Status Code: %s, Content-Type: %s, %s bytes",
+                        response.status_code, content_type, len(response.content))
+            # El cuerpo crudo solo se registra en DEBUG; el parseo lo decodifica una sola vez
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response headers: %s", dict(response.headers))
+                logger.debug("Response raw content: %.500s", response.content)
             
             # Check if response is empty
             if not response.content or len(response.content) == 0:
@@ -233,20 +249,17 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
                 continue
             
             # Check content type
-            content_type = response.headers.get('Content-Type', '')
-            logger.info(f"Content-Type de respuesta: {content_type}")
-            
             if 'application/json' not in content_type.lower():
-                logger.warning(f"Content-Type no es JSON: {content_type}")
-                logger.warning(f"Respuesta completa: {response.text}")
+                logger.warning("Content-Type no es JSON: %s", content_type)
             
             # Try to parse response
             try:
-                response_data = response.json()
-                logger.info(f"Response body parseado exitosamente: {json.dumps(response_data)}")
-            except json.JSONDecodeError as json_err:
-                logger.error(f"Error al parsear JSON: {str(json_err)}")
-                logger.error(f"Contenido que causó el error: {response.text}")
+                # Decode straight from bytes; skips requests' charset detection
+                response_data = json.loads(response.content)
+                logger.info("Response body parseado exitosamente: %s", response_data)
+            except ValueError as json_err:  # JSONDecodeError / UnicodeDecodeError
+                logger.error("Error al parsear JSON: %s", json_err)
+                logger.error("Contenido que causó el error: %.500s", response.content)
                 
                 # Si es el último intento, retornar error (matching OpenAPI 500 schema)
                 if attempt == MAX_RETRIES - 1:
@@ -273,8 +286,7 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
                 'data': response_data
             }
             
-        except requests.exceptions.Timeout as e:
-            last_exception = e
+        except requests.exceptions.Timeout:
             logger.error(f"Timeout en intento {attempt + 1}/{MAX_RETRIES} (30 segundos)")
             
             # Si es el último intento, retornar error (matching OpenAPI 504 schema)
@@ -294,7 +306,6 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
             time.sleep(backoff_time)
             
         except requests.exceptions.ConnectionError as e:
-            last_exception = e
             logger.error(f"Error de conexión en intento {attempt + 1}/{MAX_RETRIES}: {str(e)}")
             
             # Si es el último intento, retornar error (matching OpenAPI 503 schema)
@@ -314,7 +325,6 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
             time.sleep(backoff_time)
             
         except requests.exceptions.RequestException as e:
-            last_exception = e
             logger.error(f"Error en la solicitud HTTP en intento {attempt + 1}/{MAX_RETRIES}: {str(e)}")
             
             # Si es el último intento, retornar error (matching OpenAPI 500 schema)
@@ -345,17 +355,6 @@ def call_identity_validation_api(tipo_documento: str, numero_documento: str) ->
                     'errorCode': 'UNEXPECTED_ERROR'
                 }
             }
-    
-    # Si llegamos aquí, algo salió mal en todos los intentos (matching OpenAPI 500 schema)
-    logger.error(f"❌ Falló después de {MAX_RETRIES} intentos")
-    return {
-        'status_code': 500,
-        'data': {
-            'success': False,
-            'message': f'Error después de {MAX_RETRIES} intentos: {str(last_exception)}',
-            'errorCode': 'MAX_RETRIES_EXCEEDED'
-        }
-    }
 
 
 def calculate_backoff(attempt):
@@ -387,23 +386,19 @@ def get_mock_response(documento: str, tipo_documento: str) -> Dict[str, Any]:
     """
     logger.info(f"🎭 Getting mock response for documento: {documento[:3]}***")
     
-    # Simulate network delay (random between 0.5-2 seconds)
-    import random
-    delay = random.uniform(0.5, 2.0)
     random_otp = random.randint(1000, 9999)
     success = False
-
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
     
-    logger.info(f"🎭 Simulating API delay: {delay:.2f}s")
-    time.sleep(delay)
-
-    # Update OTP in DynamoDB table    
-    db_table = dynamodb.Table(MOCK_TABLE)
+    # Simulate network delay only when MOCK_LATENCY_MAX is configured
+    if MOCK_LATENCY_MAX > 0:
+        delay = random.uniform(0, MOCK_LATENCY_MAX)
+        logger.info(f"🎭 Simulating API delay: {delay:.2f}s")
+        time.sleep(delay)
 
+    # Update OTP in DynamoDB table
     try:
         logger.info(f"🎭 Actualizando OTP en DynamoDB para documento {documento[:3]}***")
-        response = db_table.update_item(
+        response = mock_table.update_item(
             Key={'documento': documento},
             UpdateExpression="SET otp = :otp, otp_timestamp = :ts",
             ExpressionAttributeValues={
@@ -508,14 +503,14 @@ def send_mock_email(email: str, otp: str) -> None:
         return False
 
 
-def format_bedrock_response(status_code: int, body: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+def format_bedrock_response(status_code: int, body: Dict[str, Any], envelope_meta: Dict[str, str]) -> Dict[str, Any]:
     """
     Format response for Bedrock Agent
     
     Args:
         status_code: HTTP status code
         body: Response body
-        event: Original event from Bedrock Agent
+        envelope_meta: actionGroup, apiPath and httpMethod taken from the original event
     
     Returns:
         Formatted response for Bedrock Agent
@@ -525,9 +520,7 @@ def format_bedrock_response(status_code: int, body: Dict[str, Any], event: Dict[
     formatted_response = {
         'messageVersion': '1.0',
         'response': {
-            'actionGroup': event.get('actionGroup', ''),
-            'apiPath': event.get('apiPath', ''),
-            'httpMethod': event.get('httpMethod', ''),
+            **envelope_meta,
             'httpStatusCode': status_code,
             'responseBody': {
                 'application/json': {
@@ -537,5 +530,6 @@ def format_bedrock_response(status_code: int, body: Dict[str, Any], event: Dict[
         }
     }
     
-    logger.info(f"Respuesta formateada: {json.dumps(formatted_response, ensure_ascii=False)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Respuesta formateada: %s", json.dumps(formatted_response, ensure_ascii=False))
     return formatted_response
\ No newline at end of file
@@ -2,30 +2,153 @@
 Lambda Function: Validar OTP
 Valida el código OTP ingresado por el usuario y guarda el token JWT en DynamoDB
 """
+import hmac
 import json
 import logging
 import time
 import os
 import random
-import requests
+import secrets
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+# boto3 se importa al inicio a propósito: todas las rutas con datos (incluido MOCK) usan
+# DynamoDB. requests sí se difiere, ver get_http_session()
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Cliente DynamoDB
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+# Cliente DynamoDB (keep-alive TCP y pool de conexiones para contenedores calientes)
+DYNAMODB_CONFIG = Config(
+    region_name='us-east-1',
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    connect_timeout=1,
+    read_timeout=3
+)
+# Se usa el cliente de bajo nivel (no boto3.resource): evita cargar el modelo de recursos
+# en el cold start y la capa de TypeSerializer en cada llamada. Los atributos se tipan a mano.
+# Las lecturas van directo a DynamoDB (no DAX): el OTP mock lo reescribe ValidarIdentidad
+# y intentosRestantes se actualiza aquí mismo, así que un item cache serviría datos viejos.
+dynamodb = boto3.client('dynamodb', config=DYNAMODB_CONFIG)
 TABLE_NAME = 'cat-test-certification-session-tokens'
 MOCK_USERS_TABLE = 'cat-test-mock-users'
 
-# Configuración de reintentos con exponential backoff
-MAX_RETRIES = 10
+# Sesión HTTP reutilizada entre invocaciones (keep-alive sobre el contenedor caliente).
+# Se crea en el primer uso para que el modo MOCK no importe requests en el cold start.
+_SESSION = None
+VALIDAR_OTP_URL = "http://vmprocondock.catastrobogota.gov.co:3400/catia-auth/auth/login"
+# Timeout (connect, read) del pre-calentamiento en INIT: nunca debe demorar el arranque
+WARMUP_TIMEOUT = (1, 2)
+# Espera máxima del GetItem de pre-calentamiento en INIT (límite de 10s); los reintentos
+# de DYNAMODB_CONFIG podrían tardar más, así que INIT deja de esperar a este tope
+WARMUP_DYNAMODB_BUDGET = 2  # segundos
+
+# Pool para solapar la escritura en DynamoDB con la construcción de la respuesta.
+# Lambda congela el contenedor al retornar, por lo que siempre se espera el resultado.
+# Se usan hilos y no asyncio (aiohttp/aioboto3): esas librerías no están en el layer y la
+# escritura depende del resultado del API, así que no hay más I/O que solapar.
+_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+SAVE_TOKEN_TIMEOUT = 10  # segundos
+
+# Configuración de reintentos con backoff exponencial (decorrelated jitter)
+# Pocos reintentos: la invocación es síncrona para el usuario y cada reintento extiende la Lambda
+MAX_RETRIES = 3
 INITIAL_BACKOFF = 1
 MAX_BACKOFF = 60
+# Respuestas vacías o no-JSON rara vez se corrigen reintentando: cortar antes.
+# Debe ser <= MAX_RETRIES: cada rama del ciclo retorna a más tardar en el último intento
+MAX_RESPONSE_RETRIES = 2
+# Timeout del API (connect, read): un upstream caído falla en 1s, uno lento en 8s
+API_TIMEOUT = (1, 8)
+
+# Circuit breaker del API de login (compartido por las invocaciones del contenedor)
+# Tras BREAKER_THRESHOLD fallos transitorios consecutivos se deja de llamar durante BREAKER_COOLDOWN s
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+_BREAKER = {'open_until': 0, 'failures': 0}
+
+# Intentos de OTP permitidos por usuario
+MAX_OTP_ATTEMPTS = 3
+
+# Máximo de bytes del cuerpo de respuesta que se escriben en los logs
+LOG_PREVIEW_CHARS = 120
+
+# Cache en memoria de validaciones exitosas (absorbe reintentos duplicados del Agent)
+# Solo se cachean éxitos; el TTL se mantiene corto (<= 30s) por seguridad.
+# La clave incluye el sessionId: otra sesión que repita el mismo código no reutiliza el JWT
+VALIDATION_CACHE_TTL = 30
+_validation_cache = {}
+
+# Documentos cuyo mapa usuario ya escribió este contenedor: documento -> (hash, ttl del item)
+# Solo se registra tras un SET efectivo del mapa; mientras el item no expire y los datos
+# no cambien, se omite reenviarlo
+USUARIO_CACHE_MAX = 100
+_usuario_written = {}
 
 # Modo MOCK
 ENABLE_MOCK = os.environ.get('ENABLE_MOCK', 'false').lower() == 'true'
+# Latencia simulada del API en modo MOCK (segundos máximos, 0 = deshabilitada)
+MOCK_LATENCY_MAX = float(os.environ.get('MOCK_LATENCY_MAX', '0'))
+
+# Cuerpos de respuesta constantes, serializados una sola vez al importar el módulo
+# (Bedrock espera el body como str, por eso no se guardan como bytes)
+_ERR_MISSING_PARAMS_BODY = json.dumps({
+    "success": False,
+    "intentosRestantes": 0,
+    "message": "Documento y código son requeridos"
+}, ensure_ascii=False)
+_SUCCESS_BODY = json.dumps({
+    "success": True,
+    "intentosRestantes": MAX_OTP_ATTEMPTS,
+    "message": " Código OTP válido"
+}, ensure_ascii=False)
+_ERR_INTERNAL_BODY = json.dumps({
+    "success": False,
+    "intentosRestantes": 0,
+    "message": "Error interno al procesar la validación"
+}, ensure_ascii=False)
+
+
+def _ddb_s(value):
+    """Atributo DynamoDB tipado string (NULL si el valor es None)"""
+    return {'NULL': True} if value is None else {'S': str(value)}
+
+
+def _ddb_n(value):
+    """Atributo DynamoDB tipado numérico"""
+    return {'N': str(value)}
+
+
+def _ddb_get_s(item, name):
+    """Lee un atributo string de un item tipado (None si no existe)"""
+    return item.get(name, {}).get('S')
+
+
+def _ddb_usuario(usuario, documento):
+    """Mapa tipado del usuario sin campos vacíos ({} si no hay datos de usuario)"""
+    if not usuario:
+        return {}
+    return {
+        campo: _ddb_s(valor)
+        for campo, valor in (
+            ('nombre', usuario.get('nombre')),
+            ('apellido', usuario.get('apellido')),
+            ('email', usuario.get('email')),
+            ('numeroDocumento', usuario.get('numeroDocumento') or documento)
+        )
+        if valor
+    }
+
+
+def _log(event_name, **fields):
+    """
+    Emite un único registro estructurado (evento + campos) en lugar de varias líneas
+    """
+    logger.info("%s %s", event_name, fields)
 
 
 def get_mock_user_from_dynamodb(documento):
@@ -38,42 +161,36 @@ def get_mock_user_from_dynamodb(documento):
     Returns:
         dict: Datos esenciales del usuario {otp, tipoDocumento, documento} o None si no existe
     """
-    logger.info(f"[MOCK]  Consultando usuario mock en DynamoDB: {documento[:3]}***")
-    
     try:
-        table = dynamodb.Table(MOCK_USERS_TABLE)
-        
-        # Consulta por Primary Key (documento)
-        response = table.get_item(Key={'documento': documento})
+        # Consulta por Primary Key (documento), solo los atributos usados
+        response = dynamodb.get_item(
+            TableName=MOCK_USERS_TABLE,
+            Key={'documento': _ddb_s(documento)},
+            ProjectionExpression='otp, tipoDocumento, correo'
+        )
         
         if 'Item' in response:
             user_data = response['Item']
-            logger.info(f"[MOCK]  Usuario encontrado en {MOCK_USERS_TABLE}")
-            logger.info(f"[MOCK]   - Tipo documento: {user_data.get('tipoDocumento', 'N/A')}")
-            logger.info(f"[MOCK]   - OTP almacenado: {user_data.get('otp', 'N/A')[:2]}****")
-            logger.info(f"[MOCK]   - Email: {user_data.get('correo', 'N/A')}")
+            correo = _ddb_get_s(user_data, 'correo')
+            _log('mock_user_found', table=MOCK_USERS_TABLE, doc3=documento[:3],
+                 tipoDoc=_ddb_get_s(user_data, 'tipoDocumento') or 'N/A', tieneCorreo=bool(correo))
             
             return {
-                'otp': user_data.get('otp'),
-                'tipoDocumento': user_data.get('tipoDocumento'),
-                'correo': user_data.get('correo'),  # ← EMAIL de la tabla mock
+                'otp': _ddb_get_s(user_data, 'otp'),
+                'tipoDocumento': _ddb_get_s(user_data, 'tipoDocumento'),
+                'correo': correo,  # ← EMAIL de la tabla mock
                 'documento': documento
             }
         else:
-            logger.warning(f"[MOCK]  Usuario NO encontrado en {MOCK_USERS_TABLE}: {documento[:3]}***")
+            logger.warning("[MOCK] Usuario NO encontrado en %s: %s***", MOCK_USERS_TABLE, documento[:3])
             return None
             
     except ClientError as e:
-        error_code = e.response['Error']['Code']
-        error_message = e.response['Error']['Message']
-        logger.error(f"[MOCK]  Error consultando {MOCK_USERS_TABLE}: {error_code}")
-        logger.error(f"[MOCK]   - Mensaje: {error_message}")
-        logger.error(f"[MOCK]   - Documento: {documento[:3]}***")
+        logger.error("[MOCK] Error consultando %s: %s - %s (documento %s***)",
+                     MOCK_USERS_TABLE, e.response['Error']['Code'], e.response['Error']['Message'], documento[:3])
         return None
     except Exception as e:
-        logger.error(f"[MOCK]  Error inesperado consultando usuario mock")
-        logger.error(f"[MOCK]   - Tipo error: {type(e).__name__}")
-        logger.error(f"[MOCK]   - Mensaje: {str(e)}")
+        logger.error("[MOCK] Error inesperado consultando usuario mock: %s - %s", type(e).__name__, e)
         return None
 
 
@@ -89,29 +206,26 @@ def get_mock_otp_response(documento, codigo, tipo_documento):
     Returns:
         dict: Respuesta simulada con validación real contra DynamoDB
     """
-    logger.info("[MOCK] 🎭 Generando respuesta mock para ValidarOTP")
-    logger.info(f"[MOCK] Documento: {tipo_documento}-{documento[:3]}***")
-    logger.info(f"[MOCK] Código: {codigo[:2] if codigo else 'N/A'}****")
+    _log('mock_otp_start', tipoDoc=tipo_documento, doc3=documento[:3], codLen=len(codigo or ''))
     
-    # Simular delay realista del API (0.5s - 2s)
-    delay = random.uniform(0.5, 2.0)
-    logger.info(f"[MOCK] Simulando delay de {delay:.2f} segundos...")
-    time.sleep(delay)
+    # Simular delay del API solo si se configuró MOCK_LATENCY_MAX
+    if MOCK_LATENCY_MAX > 0:
+        delay = random.uniform(0, MOCK_LATENCY_MAX)
+        logger.info("[MOCK] Simulando delay de %.2f segundos...", delay)
+        time.sleep(delay)
     
     # Validar formato básico del código
-    if not codigo or len(codigo) != 4 or not codigo.isdigit():
-        logger.warning(f"[MOCK]  Código inválido (debe ser 4 dígitos): {codigo}")
+    if not codigo or len(codigo) != 4 or not (codigo.isascii() and codigo.isdigit()):
+        logger.warning("[MOCK] Código inválido (debe ser 4 dígitos)")
         return {
             "success": False,
             "message": "[MOCK] Código incorrecto"
         }
     
     #  Consultar usuario en tabla cat-test-mock-users
-    logger.info(f"[MOCK]  Validando contra tabla {MOCK_USERS_TABLE}...")
     user_data = get_mock_user_from_dynamodb(documento)
     
     if not user_data:
-        logger.warning(f"[MOCK]  Usuario no encontrado en {MOCK_USERS_TABLE}")
         return {
             "success": False,
             "message": "[MOCK] Usuario no encontrado en el sistema"
@@ -119,34 +233,30 @@ def get_mock_otp_response(documento, codigo, tipo_documento):
     
     # Validar tipo de documento
     if user_data['tipoDocumento'] != tipo_documento:
-        logger.warning(f"[MOCK]  Tipo documento no coincide:")
-        logger.warning(f"[MOCK]   - Enviado: {tipo_documento}")
-        logger.warning(f"[MOCK]   - Almacenado: {user_data['tipoDocumento']}")
+        logger.warning("[MOCK] Tipo documento no coincide: enviado=%s almacenado=%s",
+                       tipo_documento, user_data['tipoDocumento'])
         return {
             "success": False,
             "message": "[MOCK] Tipo de documento no coincide"
         }
     
     #  Validar código OTP contra el almacenado
+    # Comparación en tiempo constante; los valores de OTP no se registran en logs
     otp_almacenado = user_data['otp']
-    logger.info(f"[MOCK]  Comparando códigos:")
-    logger.info(f"[MOCK]   - Enviado: {codigo}")
-    logger.info(f"[MOCK]   - Almacenado: {otp_almacenado}")
     
-    if otp_almacenado != codigo:
-        logger.warning(f"[MOCK]  Código OTP no coincide")
+    # compare_digest sobre str solo admite ASCII; se comparan bytes para no romper con dígitos Unicode
+    if not hmac.compare_digest(str(otp_almacenado or '').encode(), str(codigo or '').encode()):
+        logger.warning("[MOCK] Código OTP no coincide")
         return {
             "success": False,
             "message": "[MOCK] Código incorrecto"
         }
     
     #  OTP VÁLIDO - Generar respuesta exitosa
-    logger.info(f"[MOCK]  OTP VÁLIDO - Usuario autenticado exitosamente")
-    
     # Generar token JWT mock (formato realista)
     timestamp = int(time.time())
-    token_mock = f"MOCK_JWT_TOKEN_{documento}_{timestamp}_{random.randint(1000, 9999)}"
-    refresh_token_mock = f"MOCK_REFRESH_TOKEN_{documento}_{timestamp}_{random.randint(5000, 9999)}"
+    token_mock = f"MOCK_JWT_TOKEN_{documento}_{timestamp}_{secrets.token_hex(4)}"
+    refresh_token_mock = f"MOCK_REFRESH_TOKEN_{documento}_{timestamp}_{secrets.token_hex(4)}"
     
     # Datos del usuario para respuesta
     usuario_data = {
@@ -157,35 +267,207 @@ def get_mock_otp_response(documento, codigo, tipo_documento):
         "numeroDocumento": documento
     }
     
-    logger.info(f"[MOCK] Token generado (longitud): {len(token_mock)} caracteres")
-    logger.info(f"[MOCK] Usuario: {usuario_data['nombre']} {usuario_data['apellido']}")
+    _log('mock_otp_valid', doc3=documento[:3], tokenLen=len(token_mock))
     
+    # Mismos campos que call_validar_otp en éxito
     return {
         "success": True,
-        "intentosRestantes": 3,
-        "message": "✅ Código OTP válido (MOCK)",
         "token": token_mock,
         "refreshToken": refresh_token_mock,
-        "tokenType": "Bearer",
-        "expiresIn": 600,  # 10 minutos
         "usuario": usuario_data
     }
 
 
-def calculate_backoff(attempt):
+def get_cached_validation(session_id, documento, codigo, tipo_documento):
     """
-    Calcula el tiempo de espera usando exponential backoff
+    Retorna una validación exitosa reciente de la misma sesión para los mismos datos
     
-    Formula: min(INITIAL_BACKOFF * (2 ^ attempt), MAX_BACKOFF)
+    Returns:
+        dict: Respuesta cacheada o None si no hay entrada vigente (o no hay sessionId)
+    """
+    if not session_id:
+        return None
+    key = (session_id, documento, codigo, tipo_documento)
+    entry = _validation_cache.get(key)
+    if entry is None:
+        return None
+    expiry, api_response = entry
+    if expiry <= time.monotonic():
+        _validation_cache.pop(key, None)
+        return None
+    return api_response
+
+
+def cache_validation(session_id, documento, codigo, tipo_documento, api_response):
+    """
+    Guarda una validación exitosa de la sesión durante VALIDATION_CACHE_TTL segundos
+    
+    Sin sessionId no se cachea: no habría forma de distinguir un reintento de la
+    misma invocación de otra sesión que repite el código.
+    """
+    if not session_id:
+        return
+    now = time.monotonic()
+    # Purgar entradas vencidas para acotar la memoria del contenedor
+    for key in [k for k, (expiry, _) in _validation_cache.items() if expiry <= now]:
+        del _validation_cache[key]
+    _validation_cache[(session_id, documento, codigo, tipo_documento)] = (now + VALIDATION_CACHE_TTL, api_response)
+
+
+def calculate_backoff(previous_backoff):
+    """
+    Calcula el tiempo de espera usando "decorrelated jitter" (AWS)
+    
+    Formula: U(INITIAL_BACKOFF, min(MAX_BACKOFF, previous_backoff * 3))
     
     Args:
-        attempt: Número de intento (0-indexed)
+        previous_backoff: Espera anterior en segundos (INITIAL_BACKOFF en el primer reintento)
     
     Returns:
         float: Tiempo de espera en segundos
     """
-    backoff = INITIAL_BACKOFF * (2 ** attempt)
-    return min(backoff, MAX_BACKOFF)
+    return random.uniform(INITIAL_BACKOFF, min(MAX_BACKOFF, previous_backoff * 3))
+
+
+def _should_retry(resp):
+    """
+    Indica si una respuesta HTTP sin JSON utilizable amerita reintento
+    
+    Solo se reintenta lo transitorio: 5xx o cuerpo vacío (salvo 4xx). Una respuesta
+    JSON (OTP incorrecto, expirado, bloqueado) es un resultado semántico y nunca se
+    reintenta; Timeout y ConnectionError se reintentan en sus propios except.
+    
+    Args:
+        resp: requests.Response recibido
+    
+    Returns:
+        bool: True si se debe reintentar
+    """
+    if resp.status_code >= 500:
+        return True
+    return not resp.content and not 400 <= resp.status_code < 500
+
+
+def _breaker_record_failure():
+    """
+    Registra un fallo transitorio del API; abre el breaker al llegar a BREAKER_THRESHOLD
+    """
+    _BREAKER['failures'] += 1
+    if _BREAKER['failures'] >= BREAKER_THRESHOLD:
+        _BREAKER['open_until'] = time.monotonic() + BREAKER_COOLDOWN
+        _BREAKER['failures'] = 0
+        logger.error(" Circuit breaker abierto por %ss tras %s fallos consecutivos", BREAKER_COOLDOWN, BREAKER_THRESHOLD)
+
+
+def _breaker_open():
+    """
+    Indica si el circuit breaker está abierto (no se debe llamar al API)
+    """
+    return time.monotonic() < _BREAKER['open_until']
+
+
+def _wait_before_retry(backoff_time, reason):
+    """
+    Espera con decorrelated jitter antes del siguiente intento
+    
+    Si el fallo recién registrado abrió el breaker no se duerme: el siguiente
+    intento retorna de inmediato el error técnico.
+    
+    Args:
+        backoff_time: Espera anterior en segundos
+        reason: Motivo del reintento para el log
+    
+    Returns:
+        float: Espera usada (base para el siguiente reintento)
+    """
+    if _breaker_open():
+        return backoff_time
+    backoff_time = calculate_backoff(backoff_time)
+    logger.warning(" %s. Reintentando en %.2fs...", reason, backoff_time)
+    time.sleep(backoff_time)
+    return backoff_time
+
+
+def _breaker_record_success():
+    """
+    Reinicia el conteo de fallos tras una respuesta válida del API
+    """
+    _BREAKER['failures'] = 0
+
+
+def get_http_session():
+    """
+    Retorna la sesión HTTP del contenedor, importando requests y creándola en el primer uso
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _SESSION = requests.Session()
+        # Sin cookies: la sesión se comparte entre usuarios y un Set-Cookie no debe viajar a otra invocación
+        _SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # Cabeceras fijas definidas una vez; cada post solo envía el payload
+        _SESSION.headers.update({
+            "Content-Type": "application/json",
+            "Connection": "keep-alive"
+        })
+        _SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+    return _SESSION
+
+
+def _warmup():
+    """
+    Abre las conexiones del contenedor durante INIT para que la primera invocación
+    no pague credenciales, firma y handshake: DynamoDB siempre y, fuera de modo MOCK,
+    el socket keep-alive hacia el API de validación. Los errores solo se registran.
+    
+    El GetItem usa el cliente del módulo (su pool es el que atiende las invocaciones)
+    y se espera a lo sumo WARMUP_DYNAMODB_BUDGET segundos.
+    """
+    try:
+        # GetItem sobre una clave inexistente: usa el permiso que ya tiene el rol
+        _EXECUTOR.submit(
+            dynamodb.get_item,
+            TableName=TABLE_NAME,
+            Key={'documento': _ddb_s('__warmup__')},
+            ProjectionExpression='documento'
+        ).result(timeout=WARMUP_DYNAMODB_BUDGET)
+    except FuturesTimeoutError:
+        logger.warning("Pre-calentamiento de DynamoDB superó %ss, se continúa sin esperar", WARMUP_DYNAMODB_BUDGET)
+    except Exception as e:
+        logger.warning("Pre-calentamiento de DynamoDB falló: %s", e)
+    
+    if not ENABLE_MOCK:
+        try:
+            # Cualquier status sirve: lo que se busca es dejar la conexión en el pool
+            get_http_session().head(VALIDAR_OTP_URL, timeout=WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("Pre-calentamiento del API de validación falló: %s", e)
+
+
+def _extract_params(event):
+    """
+    Extrae (documento, codigo, tipoDocumento) del evento en una sola pasada
+    
+    Bedrock Agent envía properties como array de objetos dentro de requestBody;
+    sin requestBody se asume el formato directo usado en testing.
+    """
+    request_body = event.get('requestBody')
+    if not request_body:
+        return event.get('documento', ''), event.get('codigo', ''), event.get('tipoDocumento', '')
+    
+    # Recorrido único sobre properties, sin construir un dict intermedio
+    documento = codigo = tipo_documento = ''
+    properties = request_body.get('content', {}).get('application/json', {}).get('properties', ())
+    for prop in properties:
+        name = prop['name']
+        if name == 'documento':
+            documento = prop['value']
+        elif name == 'codigo':
+            codigo = prop['value']
+        elif name == 'tipoDocumento':
+            tipo_documento = prop['value']
+    return documento, codigo, tipo_documento
 
 
 def handler(event, context):
@@ -206,47 +488,41 @@ def handler(event, context):
     }
     """
     logger.info("=== Lambda: Validar OTP ===")
-    if ENABLE_MOCK:
-        logger.info("[MOCK] 🎭 MODO MOCK HABILITADO")
-    logger.info(f"Event: {json.dumps(event)}")
+    # Un único "ahora" por invocación para createdAt, TTL y last_otp_attempt
+    now = int(time.time())
+    # El evento completo incluye el código OTP en claro: solo se vuelca en DEBUG
+    logger.info("%sactionGroup: %s, sessionId: %s", "[MOCK] " if ENABLE_MOCK else "",
+                event.get('actionGroup'), event.get('sessionId'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Event: %s", event)
     
     # Extraer datos del evento - Bedrock Agent envía en requestBody
-    if 'requestBody' in event and 'content' in event['requestBody']:
-        content = event['requestBody']['content']
-        if 'application/json' in content:
-            # Bedrock Agent envía properties como array de objetos
-            properties = content['application/json']['properties']
-            body = {prop['name']: prop['value'] for prop in properties}
-            documento = body.get('documento', '')
-            codigo = body.get('codigo', '')
-            tipo_documento = body.get('tipoDocumento', '')
-        else:
-            documento = ''
-            codigo = ''
-            tipo_documento = ''
-    else:
-        # Formato directo para testing
-        documento = event.get('documento', '')
-        codigo = event.get('codigo', '')
-        tipo_documento = event.get('tipoDocumento', '')
+    documento, codigo, tipo_documento = _extract_params(event)
     
     # Obtener sessionId para guardar token
     session_id = event.get('sessionId', '')
     
+    # Máscaras para logs, calculadas una sola vez por invocación
+    doc_mask = f"{documento[:3]}***" if documento else '[VACÍO]'
+    cod_mask = f"{codigo[:2]}****" if codigo else '[VACÍO]'
+    
     # Log de parámetros extraídos
-    logger.info("Parámetros extraídos del evento:")
-    logger.info(f"  - sessionId: {session_id if session_id else '[VACÍO]'}")
-    logger.info(f"  - documento: {documento[:3] if documento else '[VACÍO]'}*** (longitud: {len(documento)})")
-    logger.info(f"  - codigo: {codigo[:2] if codigo else '[VACÍO]'}**** (longitud: {len(codigo)})")
-    logger.info(f"  - tipoDocumento: {tipo_documento if tipo_documento else '[VACÍO]'}")
+    _log('params', sessionId=session_id or '[VACÍO]', doc=doc_mask, docLen=len(documento),
+         codLen=len(codigo), tipoDoc=tipo_documento or '[VACÍO]')
     
     # Validación de inputs
     if not documento or not codigo:
         logger.error("Documento o código vacío")
+        return build_response(event, _ERR_MISSING_PARAMS_BODY, 200)
+    
+    # Formato del código: 4 dígitos. Se rechaza antes de llamar al API externo
+    # isdigit() acepta dígitos Unicode ('١٢٣٤'); se exige ASCII
+    if len(codigo) != 4 or not (codigo.isascii() and codigo.isdigit()):
+        logger.warning("Código con formato inválido (longitud: %s)", len(codigo))
         return build_response(event, {
             "success": False,
-            "intentosRestantes": 0,
-            "message": "Documento y código son requeridos"
+            "intentosRestantes": get_current_otp_attempts(documento),
+            "message": "Código inválido"
         }, 200)
     
     # Tipo de documento ya fue validado en lambda "ValidarIdentidad" (Paso 2)
@@ -255,17 +531,19 @@ def handler(event, context):
         logger.warning("Tipo documento no proporcionado, usando 'CC' por defecto")
         tipo_documento = 'CC'
     
-    logger.info(f"Validando OTP para documento: {tipo_documento}-{documento[:3]}***")
-    logger.debug(f"Código OTP (debug): {codigo[:2]}****")
+    logger.info("Validando OTP para documento: %s-%s", tipo_documento, doc_mask)
+    logger.debug("Código OTP (debug): %s", cod_mask)
     
     try:
-        # DECISIÓN: ¿Usar MOCK o API real?
-        if ENABLE_MOCK:
-            logger.info("[MOCK] 🎭 Usando validación MOCK (API externa NO será llamada)")
-            logger.info("[MOCK] Valida código OTP contra tabla cat-test-mock-users")
+        # DECISIÓN: ¿Cache, MOCK o API real?
+        api_response = get_cached_validation(session_id, documento, codigo, tipo_documento)
+        if api_response is not None:
+            logger.info(" Validación exitosa reciente encontrada en cache, se omite la llamada")
+        elif ENABLE_MOCK:
+            logger.info("[MOCK] Validando OTP contra %s (API externa NO será llamada)", MOCK_USERS_TABLE)
             api_response = get_mock_otp_response(documento, codigo, tipo_documento)
         else:
-            logger.info("📡 Llamando API externa REAL")
+            logger.info("Llamando API externa REAL")
             api_response = call_validar_otp(documento, codigo, tipo_documento)
         
         # Procesar respuesta
@@ -273,51 +551,64 @@ def handler(event, context):
             # OTP CORRECTO
             logger.info(" OTP validado correctamente")
             
-            # Guardar token en DynamoDB
-            token_saved = save_token_to_dynamodb(
+            # Guardar token en DynamoDB en segundo plano; mientras tanto se cachea la
+            # validación y se arma la respuesta completa (el body de éxito es constante)
+            save_future = _EXECUTOR.submit(
+                save_token_to_dynamodb,
                 session_id=session_id,
                 token=api_response.get('token'),
                 refresh_token=api_response.get('refreshToken', ''),
                 documento=documento,
                 tipo_documento=tipo_documento,
-                usuario=api_response.get('usuario', {})
+                usuario=api_response.get('usuario', {}),
+                now=now
             )
+            cache_validation(session_id, documento, codigo, tipo_documento, api_response)
+            success_response = build_response(event, _SUCCESS_BODY, 200)
+            
+            # Lambda congela el contenedor al retornar: siempre se espera la escritura
+            try:
+                token_saved = save_future.result(timeout=SAVE_TOKEN_TIMEOUT)
+            except FuturesTimeoutError:
+                logger.error("Timeout (%ss) esperando el guardado del token en DynamoDB", SAVE_TOKEN_TIMEOUT)
+                token_saved = False
             
             if token_saved:
-                logger.info(f"Token guardado en DynamoDB para session: {session_id}")
+                # save_token_to_dynamodb ya reinicia intentosRestantes en el mismo UpdateItem
+                logger.info("Token guardado en DynamoDB para session: %s", session_id)
             else:
                 logger.warning("No se pudo guardar token en DynamoDB")
+                # Reset intentos a 3 cuando OTP es exitoso
+                update_otp_attempts(documento, MAX_OTP_ATTEMPTS, now=now)
             
-            # Reset intentos a 3 cuando OTP es exitoso
-            update_otp_attempts(documento, 3)
+            logger.info("Response: %s", _SUCCESS_BODY)
+            return success_response
+        elif api_response.get('technicalError'):
+            # El código no llegó a validarse (breaker abierto, timeouts, 5xx o respuesta inválida):
+            # se informan los intentos sin descontar; una caída del upstream no bloquea al usuario
+            message = api_response.get('message', 'Error técnico')
+            logger.warning(" Validación no realizada: %s", message)
             
             response = {
-                "success": True,
-                "intentosRestantes": 3,
-                "message": " Código OTP válido"
+                "success": False,
+                "intentosRestantes": get_current_otp_attempts(documento),
+                "message": message
             }
         else:
             # OTP INCORRECTO - Decrementar intentos
             message = api_response.get('message', 'Código incorrecto')
             
-            logger.warning(f" OTP incorrecto. Mensaje: {message}")
+            logger.warning(" OTP incorrecto. Mensaje: %s", message)
             
-            # Obtener intentos actuales y decrementar en 1
-            logger.info(f"[DEBUG] ========== DECREMENTO DE INTENTOS ==========")
-            logger.info(f"[DEBUG] Documento: {documento[:3]}***")
-            
-            intentos_actuales = get_current_otp_attempts(documento)
-            logger.info(f"[DEBUG] Intentos obtenidos de DynamoDB: {intentos_actuales}")
-            
-            intentos_restantes = max(0, intentos_actuales - 1)  # No puede ser negativo
-            logger.info(f"[DEBUG] Cálculo: {intentos_actuales} - 1 = {intentos_restantes}")
-            
-            logger.warning(f" Intentos actuales: {intentos_actuales} → Nuevo: {intentos_restantes}")
-            
-            # Guardar intentos decrementados en DynamoDB
-            logger.info(f"[DEBUG] Guardando {intentos_restantes} en DynamoDB...")
-            update_otp_attempts(documento, intentos_restantes)
-            logger.info(f"[DEBUG] ==========================================")
+            if 'intentosRestantes' in api_response:
+                # El upstream fijó los intentos (expirado, cuenta bloqueada): se guarda ese valor
+                intentos_restantes = api_response['intentosRestantes']
+                update_otp_attempts(documento, intentos_restantes, now=now)
+                logger.warning(" Intentos restantes fijados por el API: %s", intentos_restantes)
+            else:
+                # Decrementar intentos en 1 de forma atómica (un solo UpdateItem)
+                intentos_restantes = decrement_otp_attempts(documento, now=now)
+                logger.warning(" Intentos restantes tras decremento: %s", intentos_restantes)
             
             response = {
                 "success": False,
@@ -325,32 +616,15 @@ def handler(event, context):
                 "message": message
             }
         
-        logger.info(f"Response: {json.dumps(response)}")
-        return build_response(event, response, 200)
-        
-    except requests.exceptions.Timeout:
-        logger.error("Timeout llamando a la API de validación OTP")
-        return build_response(event, {
-            "success": False,
-            "intentosRestantes": 0,
-            "message": "Error técnico: timeout al validar código"
-        }, 200)
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error de red llamando a la API: {str(e)}")
-        return build_response(event, {
-            "success": False,
-            "intentosRestantes": 0,
-            "message": "Error técnico al validar el código"
-        }, 200)
+        # Serializar una sola vez: el mismo string se registra y viaja en el body
+        body = json.dumps(response, ensure_ascii=False)
+        logger.info("Response: %s", body)
+        return build_response(event, body, 200)
         
     except Exception as e:
-        logger.error(f"Error inesperado: {str(e)}", exc_info=True)
-        return build_response(event, {
-            "success": False,
-            "intentosRestantes": 0,
-            "message": "Error interno al procesar la validación"
-        }, 200)
+        # call_validar_otp maneja internamente los errores de requests (timeout, red)
+        logger.error("Error inesperado: %s", e, exc_info=True)
+        return build_response(event, _ERR_INTERNAL_BODY, 200)
 
 
 def call_validar_otp(documento, codigo, tipo_documento):
@@ -375,9 +649,14 @@ def call_validar_otp(documento, codigo, tipo_documento):
         tipo_documento: Tipo de documento (CC, CE, NIT, PAS, etc.) - REQUERIDO
     
     Returns:
-        dict con {valido, intentosRestantes, mensaje, token (opcional), usuario (opcional)}
+        dict con {success, token, refreshToken, usuario} en éxito, o {success, message,
+        intentosRestantes (opcional)} en error. Los errores técnicos (el código no llegó
+        a evaluarse) incluyen technicalError=True
     """
-    URL = "http://vmprocondock.catastrobogota.gov.co:3400/catia-auth/auth/login"
+    import requests  # diferido: solo se carga cuando se llama al API real
+    
+    URL = VALIDAR_OTP_URL
+    session = get_http_session()
     
     # Nota: tipo_documento ya fue validado en ValidarIdentidad (Paso 2)
     # Aquí solo lo usamos como dato heredado del flujo anterior
@@ -388,208 +667,197 @@ def call_validar_otp(documento, codigo, tipo_documento):
         "claveTemporal": codigo,
         "validInput": True
     }
+    # Serializar una sola vez; los reintentos reutilizan los mismos bytes
+    # (Content-Type ya viene fijado en la sesión)
+    body_bytes = json.dumps(payload).encode('utf-8')
     
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
-    logger.info(f" Llamando API para validar OTP (con exponential backoff):")
-    logger.info(f"  - Endpoint: POST {URL}")
-    logger.info(f"  - Tipo documento: {tipo_documento} (heredado de ValidarIdentidad)")
-    logger.info(f"  - Timeout: 10 segundos")
-    logger.info(f"  - Max reintentos: {MAX_RETRIES}, Backoff inicial: {INITIAL_BACKOFF}s")
-    logger.debug(f"  - Payload: {json.dumps(payload)}")
+    logger.info(" Llamando API para validar OTP: POST %s, tipo documento %s, max reintentos %s",
+                URL, tipo_documento, MAX_RETRIES)
+    logger.debug("  - Payload: %s", payload)
     
-    last_exception = None
+    backoff_time = INITIAL_BACKOFF
     
     for attempt in range(MAX_RETRIES):
+        # Circuit breaker abierto: no golpear un upstream caído
+        if _breaker_open():
+            logger.error(" Circuit breaker abierto, se omite la llamada al API")
+            # technicalError: el código no fue evaluado, el handler no debe descontar intentos
+            # (igual en todos los retornos por fallo técnico de este ciclo)
+            return {
+                "success": False,
+                "technicalError": True,
+                "message": "Error técnico: el servicio de validación no está disponible, intenta más tarde"
+            }
+        
         try:
-            logger.info(f"--- Intento {attempt + 1}/{MAX_RETRIES} ---")
+            logger.info("--- Intento %s/%s ---", attempt + 1, MAX_RETRIES)
             
-            # Timeout de 10 segundos
-            resp = requests.post(URL, json=payload, headers=headers, timeout=10)
+            resp = session.post(URL, data=body_bytes, timeout=API_TIMEOUT)
             
-            logger.info(f"  Respuesta recibida del API:")
-            logger.info(f"  - Status Code: {resp.status_code}")
-            logger.info(f"  - Content-Type: {resp.headers.get('Content-Type', 'N/A')}")
-            logger.info(f"  - Content-Length: {len(resp.content)} bytes")
-            logger.info(f"  - Response (primeros 300 chars): {resp.text[:300]}")
+            # Una sola línea por respuesta; el cuerpo truncado solo se decodifica en DEBUG
+            logger.info(" Respuesta del API: status=%s, content_type=%s, bytes=%s",
+                        resp.status_code, resp.headers.get('Content-Type', 'N/A'), len(resp.content))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("  - Response: %s", resp.content[:LOG_PREVIEW_CHARS])
             
             # Validar respuesta vacía
             if not resp.content or len(resp.content) == 0:
                 logger.error(" API retornó respuesta vacía")
+                _breaker_record_failure()
                 
-                if attempt == MAX_RETRIES - 1:
+                # Un 4xx no es transitorio; tampoco se insiste más allá de MAX_RESPONSE_RETRIES
+                if attempt >= MAX_RESPONSE_RETRIES - 1 or not _should_retry(resp):
                     return {
                         "success": False,
-                        "intentosRestantes": 0,
+                        "technicalError": True,
                         "message": "Error: El servidor retornó una respuesta vacía después de múltiples intentos"
                     }
                 
-                backoff_time = calculate_backoff(attempt)
-                logger.warning(f" Respuesta vacía. Reintentando en {backoff_time}s...")
-                time.sleep(backoff_time)
+                backoff_time = _wait_before_retry(backoff_time, "Respuesta vacía")
                 continue
             
             # Validar Content-Type
             content_type = resp.headers.get('Content-Type', '')
             if 'application/json' not in content_type.lower():
-                logger.warning(f" Content-Type no es JSON: {content_type}")
-                logger.warning(f"Respuesta completa: {resp.text[:500]}")
+                logger.warning(" Content-Type no es JSON: %s", content_type)
             
             # Intentar parsear JSON
             try:
-                response_data = resp.json()
-                logger.info(f" JSON parseado exitosamente")
+                # json.loads sobre los bytes evita la detección de charset de resp.json()
+                response_data = json.loads(resp.content)
             except ValueError as ve:
-                logger.error(f" Respuesta no es JSON válido: {resp.text[:200]}")
-                logger.error(f"  - Error: {str(ve)}")
+                logger.error(" Respuesta no es JSON válido (%s): %s", ve, resp.content[:LOG_PREVIEW_CHARS])
+                _breaker_record_failure()
                 
-                if attempt == MAX_RETRIES - 1:
+                # Un cuerpo no-JSON solo se reintenta si el upstream respondió 5xx
+                if attempt >= MAX_RESPONSE_RETRIES - 1 or not _should_retry(resp):
                     return {
                         "success": False,
-                        "intentosRestantes": 0,
+                        "technicalError": True,
                         "message": "Error en la respuesta del servidor después de múltiples intentos"
                     }
                 
-                backoff_time = calculate_backoff(attempt)
-                logger.warning(f" Error parseando JSON. Reintentando en {backoff_time}s...")
-                time.sleep(backoff_time)
+                backoff_time = _wait_before_retry(backoff_time, "Error parseando JSON")
+                continue
+            
+            # Un 5xx con cuerpo JSON sigue siendo un fallo del upstream, no un resultado
+            if resp.status_code >= 500:
+                logger.error(" API retornó status %s: %s", resp.status_code, response_data)
+                _breaker_record_failure()
+                
+                if attempt >= MAX_RESPONSE_RETRIES - 1:
+                    return {
+                        "success": False,
+                        "technicalError": True,
+                        "message": "Error al validar el código"
+                    }
+                
+                backoff_time = _wait_before_retry(backoff_time, "Error del servidor")
                 continue
             
             # Si llegamos aquí, la petición fue exitosa
-            logger.info(f" Llamada al API completada exitosamente en intento {attempt + 1}")
+            _breaker_record_success()
+            logger.info(" Llamada al API completada exitosamente en intento %s", attempt + 1)
             
             # CASO 1: 200 OK - OTP CORRECTO
             if resp.status_code == 200 and response_data.get('success'):
                 data = response_data.get('data', {})
-                usuario = data.get('usuario', {})
                 token = data.get('token', '')
                 
-                logger.info(" OTP VÁLIDO - API respondió exitosamente")
-                logger.info(f" Token JWT recibido:")
-                logger.info(f"  - Longitud: {len(token)} caracteres")
-                logger.info(f"  - Primeros 30 chars: {token[:30]}...")
-                logger.info(f"  - Tipo: {data.get('tokenType', 'Bearer')}")
-                logger.info(f"  - Expira en: {data.get('expiresIn', 86400)} segundos")
-                logger.info(f" Usuario:")
-                logger.info(f"  - Nombre: {usuario.get('nombre', 'N/A')} {usuario.get('apellido', 'N/A')}")
-                logger.info(f"  - Email: {usuario.get('email', 'N/A')}")
+                logger.info(" OTP VÁLIDO - token %s (%s chars), expira en %ss",
+                            data.get('tokenType', 'Bearer'), len(token), data.get('expiresIn', 86400))
                 
+                # Solo los campos que consume el handler; usuario pasa tal cual porque
+                # _ddb_usuario ya selecciona los campos y completa numeroDocumento
                 return {
                     "success": True,
-                    "intentosRestantes": 3,
-                    "message": "Código OTP válido",
                     "token": token,
                     "refreshToken": data.get('refreshToken', ''),
-                    "tokenType": data.get('tokenType', 'Bearer'),
-                    "expiresIn": data.get('expiresIn', 86400),
-                    "usuario": {
-                        "nombre": usuario.get('nombre', ''),
-                        "apellido": usuario.get('apellido', ''),
-                        "email": usuario.get('email', ''),
-                        "numeroDocumento": usuario.get('numeroDocumento', documento)
-                    }
+                    "usuario": data.get('usuario') or {}
                 }
             
-            # CASO 2: 400/401 - OTP INCORRECTO (con intentos restantes)
-            elif resp.status_code in [200, 200]:
-                message = response_data.get('message', '')
-                
-                # NO retornamos intentosRestantes aquí - el handler es quien calcula
+            # CASO 2: OTP EXPIRADO (el upstream lo reporta con 4xx; se evalúa antes
+            # que los demás rechazos para conservar el mensaje específico)
+            elif 'expirado' in response_data.get('message', '').lower():
                 return {
                     "success": False,
-                    "message": message
+                    "intentosRestantes": 0,
+                    "message": " El código ha expirado. Debes solicitar uno nuevo"
                 }
             
-            # CASO 3: 403 - CUENTA BLOQUEADA (0 intentos)
-            elif resp.status_code == 200:
-                message = response_data.get('message', 'Ha agotado los intentos')
+            # CASO 3: OTP INCORRECTO (con intentos restantes). El upstream lo reporta como
+            # 200 con success=false; 400/401 se atienden igual
+            elif resp.status_code in (200, 400, 401):
+                message = response_data.get('message', '')
+                
+                # NO retornamos intentosRestantes aquí - el handler descuenta uno
                 return {
                     "success": False,
                     "message": message
                 }
             
-            # CASO 4: OTP EXPIRADO
-            elif 'expirado' in response_data.get('message', '').lower():
+            # CASO 4: 403 - CUENTA BLOQUEADA (0 intentos)
+            elif resp.status_code == 403:
+                message = response_data.get('message', 'Ha agotado los intentos')
                 return {
                     "success": False,
                     "intentosRestantes": 0,
-                    "message": " El código ha expirado. Debes solicitar uno nuevo"
+                    "message": message
                 }
             
-            # CASO 5: OTRO ERROR
+            # CASO 5: OTRO ERROR (status no reconocido: no se asume que el código fue evaluado)
             else:
-                logger.error(f" Status code inesperado: {resp.status_code}, Body: {response_data}")
+                logger.error(" Status code inesperado: %s, Body: %s", resp.status_code, response_data)
                 return {
                     "success": False,
-                    "intentosRestantes": 0,
+                    "technicalError": True,
                     "message": "Error al validar el código"
                 }
         
-        except requests.exceptions.Timeout as e:
-            last_exception = e
-            logger.error(f" Timeout en intento {attempt + 1}/{MAX_RETRIES} (10 segundos)")
+        except requests.exceptions.Timeout:
+            logger.error(" Timeout en intento %s/%s (timeout %s)", attempt + 1, MAX_RETRIES, API_TIMEOUT)
+            _breaker_record_failure()
             
             if attempt == MAX_RETRIES - 1:
-                logger.error(f" Timeout después de {MAX_RETRIES} intentos")
+                logger.error(" Timeout después de %s intentos", MAX_RETRIES)
                 return {
                     "success": False,
-                    "intentosRestantes": 0,
+                    "technicalError": True,
                     "message": "Tiempo de espera agotado al validar el código OTP"
                 }
             
-            backoff_time = calculate_backoff(attempt)
-            logger.warning(f" Esperando {backoff_time}s antes de reintentar...")
-            time.sleep(backoff_time)
+            backoff_time = _wait_before_retry(backoff_time, "Timeout")
         
         except requests.exceptions.ConnectionError as e:
-            last_exception = e
-            logger.error(f" Error de conexión en intento {attempt + 1}/{MAX_RETRIES}: {str(e)}")
+            logger.error(" Error de conexión en intento %s/%s: %s", attempt + 1, MAX_RETRIES, e)
+            _breaker_record_failure()
             
             if attempt == MAX_RETRIES - 1:
-                logger.error(f" Error de conexión después de {MAX_RETRIES} intentos")
+                logger.error(" Error de conexión después de %s intentos", MAX_RETRIES)
                 return {
                     "success": False,
-                    "intentosRestantes": 0,
+                    "technicalError": True,
                     "message": "No se pudo conectar con el servidor de validación"
                 }
             
-            backoff_time = calculate_backoff(attempt)
-            logger.warning(f" Esperando {backoff_time}s antes de reintentar...")
-            time.sleep(backoff_time)
+            backoff_time = _wait_before_retry(backoff_time, "Error de conexión")
         
         except requests.exceptions.RequestException as e:
-            last_exception = e
-            logger.error(f" Error en la solicitud HTTP en intento {attempt + 1}/{MAX_RETRIES}: {str(e)}")
-            
-            if attempt == MAX_RETRIES - 1:
-                logger.error(f" Error en solicitud HTTP después de {MAX_RETRIES} intentos")
-                return {
-                    "success": False,
-                    "intentosRestantes": 0,
-                    "message": "Error en la solicitud al validar el código OTP"
-                }
-            
-            backoff_time = calculate_backoff(attempt)
-            logger.warning(f" Esperando {backoff_time}s antes de reintentar...")
-            time.sleep(backoff_time)
+            # Errores HTTP no transitorios (URL inválida, redirecciones, etc.): no reintentar
+            logger.error(" Error en la solicitud HTTP en intento %s/%s: %s", attempt + 1, MAX_RETRIES, e)
+            return {
+                "success": False,
+                "technicalError": True,
+                "message": "Error en la solicitud al validar el código OTP"
+            }
         
         except Exception as e:
-            logger.exception(f" Error inesperado en intento {attempt + 1}: {str(e)}")
+            logger.exception(" Error inesperado en intento %s: %s", attempt + 1, e)
             return {
                 "success": False,
-                "intentosRestantes": 0,
+                "technicalError": True,
                 "message": "Error inesperado al validar el código OTP"
             }
-    
-    # Si llegamos aquí, algo salió mal en todos los intentos
-    logger.error(f" Falló después de {MAX_RETRIES} intentos")
-    return {
-        "success": False,
-        "intentosRestantes": 0,
-        "message": f"Error después de {MAX_RETRIES} intentos al validar el código OTP: {str(last_exception)}"
-    }
 
 
 def get_current_otp_attempts(documento):
@@ -603,67 +871,120 @@ def get_current_otp_attempts(documento):
         int: Número de intentos restantes (default 3 si no existe el item)
     """
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        response = table.get_item(Key={'documento': documento})
+        response = dynamodb.get_item(
+            TableName=TABLE_NAME,
+            Key={'documento': _ddb_s(documento)},
+            ProjectionExpression='intentosRestantes'
+        )
         
-        logger.debug(f"[DEBUG] GetItem respuesta completa: {json.dumps(response, indent=2, default=str)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("GetItem respuesta completa: %s", json.dumps(response, indent=2, default=str))
         
         if 'Item' in response:
-            # Convertir Decimal a int (DynamoDB retorna Decimal)
-            intentos = int(response['Item'].get('intentosRestantes', 3))
-            logger.info(f" Intentos actuales en DynamoDB: {documento[:3]}*** → {intentos} intentos")
-            logger.info(f"[DEBUG] Item completo: {json.dumps(response['Item'], indent=2, default=str)}")
+            # Los números llegan como string tipado {'N': '3'}
+            intentos = int(response['Item'].get('intentosRestantes', {}).get('N', MAX_OTP_ATTEMPTS))
+            logger.info(" Intentos actuales en DynamoDB: %s*** → %s intentos", documento[:3], intentos)
             return intentos
         else:
             # Primera vez que se valida OTP, no existe item aún
-            logger.info(f" Primer intento: Item no existe en DynamoDB, iniciando con 3 intentos")
+            logger.info(" Primer intento: Item no existe en DynamoDB, iniciando con %s intentos", MAX_OTP_ATTEMPTS)
             return 3
     except ClientError as e:
-        logger.error(f"Error obteniendo intentos de DynamoDB: {e.response['Error']['Code']}")
+        logger.error("Error obteniendo intentos de DynamoDB: %s", e.response['Error']['Code'])
         return 3
     except Exception as e:
-        logger.error(f"Error inesperado obteniendo intentos: {e}")
+        logger.error("Error inesperado obteniendo intentos: %s", e)
         return 3
 
 
-def update_otp_attempts(documento, intentos_restantes):
+def update_otp_attempts(documento, intentos_restantes, now=None):
     """
     Actualiza intentosRestantes en el item existente del usuario
     
     Args:
         documento: Número de documento del usuario (PK)
         intentos_restantes: Número de intentos que quedan (0-3)
+        now: Timestamp epoch de la invocación (default: time.time())
     
     Returns:
         bool: True si se actualizó correctamente, False si falló
     """
+    if now is None:
+        now = int(time.time())
     try:
-        table = dynamodb.Table(TABLE_NAME)
-        
         # UpdateExpression: solo modifica/agrega estos campos, NO sobrescribe el item
-        table.update_item(
-            Key={'documento': documento},
+        dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key={'documento': _ddb_s(documento)},
             UpdateExpression='SET intentosRestantes = :intentos, last_otp_attempt = :timestamp',
             ExpressionAttributeValues={
-                ':intentos': intentos_restantes,
-                ':timestamp': int(time.time())
+                ':intentos': _ddb_n(intentos_restantes),
+                ':timestamp': _ddb_n(now)
             }
         )
         
-        logger.info(f" Intentos actualizados: {documento[:3]}*** → {intentos_restantes} intentos")
+        logger.info(" Intentos actualizados: %s*** → %s intentos", documento[:3], intentos_restantes)
         return True
     except ClientError as e:
-        logger.error(f"Error actualizando intentos en DynamoDB: {e.response['Error']['Code']}")
+        logger.error("Error actualizando intentos en DynamoDB: %s", e.response['Error']['Code'])
         return False
     except Exception as e:
-        logger.error(f"Error inesperado actualizando intentos: {e}")
+        logger.error("Error inesperado actualizando intentos: %s", e)
         return False
 
 
-def save_token_to_dynamodb(session_id, token,refresh_token, documento, tipo_documento, usuario):
+def decrement_otp_attempts(documento, now=None):
+    """
+    Decrementa intentosRestantes en 1 con un único UpdateItem atómico
+    
+    Si el item o el atributo no existen se parte de MAX_OTP_ATTEMPTS. La condición
+    impide bajar de 0, y el valor nuevo se obtiene con ReturnValues='UPDATED_NEW',
+    por lo que no se requiere un GetItem previo.
+    
+    Args:
+        documento: Número de documento del usuario (PK)
+        now: Timestamp epoch de la invocación (default: time.time())
+    
+    Returns:
+        int: Número de intentos restantes después del decremento (0-2)
+    """
+    if now is None:
+        now = int(time.time())
+    try:
+        response = dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key={'documento': _ddb_s(documento)},
+            UpdateExpression='SET intentosRestantes = if_not_exists(intentosRestantes, :max) - :one, last_otp_attempt = :timestamp',
+            ConditionExpression='attribute_not_exists(intentosRestantes) OR intentosRestantes > :zero',
+            ExpressionAttributeValues={
+                ':max': _ddb_n(MAX_OTP_ATTEMPTS),
+                ':one': _ddb_n(1),
+                ':zero': _ddb_n(0),
+                ':timestamp': _ddb_n(now)
+            },
+            ReturnValues='UPDATED_NEW'
+        )
+        
+        # Los números llegan como string tipado {'N': '2'}
+        intentos = int(response['Attributes']['intentosRestantes']['N'])
+        logger.info(" Intentos actualizados: %s*** → %s intentos", documento[:3], intentos)
+        return intentos
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(" Intentos ya agotados: %s*** → 0 intentos", documento[:3])
+            return 0
+        logger.error("Error decrementando intentos en DynamoDB: %s", e.response['Error']['Code'])
+        return MAX_OTP_ATTEMPTS - 1
+    except Exception as e:
+        logger.error("Error inesperado decrementando intentos: %s", e)
+        return MAX_OTP_ATTEMPTS - 1
+
+
+def save_token_to_dynamodb(session_id, token,refresh_token, documento, tipo_documento, usuario, now=None):
     """
     Guarda el token JWT en DynamoDB con TTL de 10 minutos
-    Usa UPDATE_ITEM para no sobrescribir intentosRestantes
+    Usa UPDATE_ITEM para no sobrescribir el item y, en la misma escritura,
+    reinicia intentosRestantes a MAX_OTP_ATTEMPTS
     
     Args:
         session_id: ID de sesión del Bedrock Agent
@@ -671,81 +992,94 @@ def save_token_to_dynamodb(session_id, token,refresh_token, documento, tipo_docu
         documento: Número de documento del ciudadano
         tipo_documento: Tipo de documento (CC, CE, NIT, PAS, etc.)
         usuario: Dict con datos del usuario (nombre, apellido, email)
+        now: Timestamp epoch de la invocación (default: time.time())
     
     Returns:
         bool: True si se guardó correctamente, False si hubo error
     """
-    logger.info(" Intentando guardar token en DynamoDB...")
-    logger.info(f"  - Tabla: {TABLE_NAME}")
-    logger.info(f"  - SessionId: {session_id if session_id else '[VACÍO]'}")
-    logger.info(f"  - Token (longitud): {len(token) if token else 0} caracteres")
-    logger.info(f"  - Documento: {tipo_documento}-{documento[:3] if documento else ''}***")
-    
     if not session_id or not token:
-        logger.error(" FALLO al guardar token - Validación de entrada")
-        logger.error(f"  - SessionId vacío: {not session_id}")
-        logger.error(f"  - Token vacío: {not token}")
+        logger.error("FALLO al guardar token - Validación de entrada: sessionId vacío=%s, token vacío=%s",
+                     not session_id, not token)
         return False
     
     try:
-        table = dynamodb.Table(TABLE_NAME)
+        if now is None:
+            now = int(time.time())
         
         # TTL: 10 minutos (600 segundos) - Alineado con Session TTL del Agent
-        ttl_timestamp = int(time.time()) + 600
+        ttl_timestamp = now + 600
         
-        # Construir datos del usuario
-        usuario_data = {}
-        if usuario:
-            usuario_data = {
-                'nombre': usuario.get('nombre', ''),
-                'apellido': usuario.get('apellido', ''),
-                'email': usuario.get('email', ''),
-                'numeroDocumento': usuario.get('numeroDocumento', documento)
-            }
+        # Construir datos del usuario (mapa tipado). Los campos vacíos se omiten:
+        # los lectores usan .get() y cada atributo suma bytes al item
+        usuario_data = _ddb_usuario(usuario, documento)
         
-        # Usar UPDATE_ITEM para preservar intentosRestantes y otros campos
-        table.update_item(
-            Key={'documento': documento},
-            UpdateExpression='SET sessionId = :session, #token = :token, refreshToken = :refresh, tipoDocumento = :tipo, tokenType = :tokentype, createdAt = :created, #ttl = :ttl, #usuario = :usuario',
-            ExpressionAttributeNames={
-                '#token': 'token',
-                '#usuario': 'usuario',
-                '#ttl': 'ttl'
-            },
-            ExpressionAttributeValues={
-                ':session': session_id,
-                ':token': token,
-                ':refresh': refresh_token,
-                ':tipo': tipo_documento,
-                ':tokentype': 'Bearer',
-                ':created': int(time.time()),
-                ':ttl': ttl_timestamp,
-                ':usuario': usuario_data
-            }
-        )
+        update_expression = 'SET sessionId = :session, #token = :token, tipoDocumento = :tipo, tokenType = :tokentype, createdAt = :created, #ttl = :ttl, intentosRestantes = :intentos'
+        expression_names = {
+            '#token': 'token',
+            '#ttl': 'ttl'
+        }
+        expression_values = {
+            ':session': _ddb_s(session_id),
+            ':token': _ddb_s(token),
+            ':tipo': _ddb_s(tipo_documento),
+            ':tokentype': _ddb_s('Bearer'),
+            ':created': _ddb_n(now),
+            ':ttl': _ddb_n(ttl_timestamp),
+            ':intentos': _ddb_n(MAX_OTP_ATTEMPTS)
+        }
         
-        logger.info(" Token guardado exitosamente en DynamoDB")
-        logger.info(f"  - SessionId: {session_id}")
-        logger.info(f"  - TTL: {ttl_timestamp} ({600} segundos = 10 minutos)")
-        logger.info(f"  - Documento: {tipo_documento}-{documento[:3]}***")
-        logger.info(f"  - refreshToken (primeros 10 chars): {refresh_token[:10]}...")
+        # Solo escribir el mapa usuario cuando hay datos (evita serializar un mapa vacío).
+        # SET simple: nombre, apellido o email pueden cambiar y generar-certificados lee este mapa
+        usuario_hash = None
+        usuario_set = False
         if usuario_data:
-            logger.info(f"  - Usuario: {usuario_data.get('nombre', 'N/A')} {usuario_data.get('apellido', 'N/A')}")
+            usuario_hash = hash(tuple((campo, attr.get('S')) for campo, attr in usuario_data.items()))
+            cached = _usuario_written.get(documento)
+            if cached is None or cached[0] != usuario_hash or cached[1] <= now:
+                usuario_set = True
+                update_expression += ', #usuario = :usuario'
+                expression_names['#usuario'] = 'usuario'
+                expression_values[':usuario'] = {'M': usuario_data}
+        
+        # Sin refresh token no se escribe un string vacío; se elimina el de una sesión anterior
+        if refresh_token:
+            update_expression += ', refreshToken = :refresh'
+            expression_values[':refresh'] = _ddb_s(refresh_token)
+        else:
+            update_expression += ' REMOVE refreshToken'
+        
+        # Usar UPDATE_ITEM para preservar intentosRestantes y otros campos.
+        # La condición impide que una validación más vieja (doble envío) pise un token más nuevo
+        dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key={'documento': _ddb_s(documento)},
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_not_exists(createdAt) OR createdAt <= :created',
+            ExpressionAttributeNames=expression_names,
+            ExpressionAttributeValues=expression_values
+        )
+        
+        if usuario_set:
+            # El UpdateItem aplicó el SET del mapa: recién ahora se da por escrito.
+            # El item vive al menos hasta ttl_timestamp; tras eso el mapa debe reenviarse
+            if len(_usuario_written) >= USUARIO_CACHE_MAX and documento not in _usuario_written:
+                del _usuario_written[next(iter(_usuario_written))]
+            _usuario_written[documento] = (usuario_hash, ttl_timestamp)
+        
+        _log('token_saved', table=TABLE_NAME, sessionId=session_id, tipoDoc=tipo_documento,
+             doc3=documento[:3], tokenLen=len(token), ttl=ttl_timestamp, conUsuario=usuario_set)
         return True
         
     except ClientError as e:
-        error_code = e.response['Error']['Code']
-        error_message = e.response['Error']['Message']
-        logger.error(f" Error de DynamoDB: {error_code}")
-        logger.error(f"  - Mensaje: {error_message}")
-        logger.error(f"  - Tabla: {TABLE_NAME}")
-        logger.error(f"  - SessionId: {session_id}")
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            # Ya hay un token más reciente para el documento: nada que escribir
+            logger.info("Token más reciente ya almacenado para %s***, se omite la escritura", documento[:3])
+            return True
+        logger.error("Error de DynamoDB guardando token en %s (session %s): %s - %s",
+                     TABLE_NAME, session_id, e.response['Error']['Code'], e.response['Error']['Message'])
         return False
     except Exception as e:
-        logger.error(f" Error inesperado guardando token")
-        logger.error(f"  - Tipo de error: {type(e).__name__}")
-        logger.error(f"  - Mensaje: {str(e)}")
-        logger.exception("Stack trace completo:")
+        logger.exception("Error inesperado guardando token: %s - %s", type(e).__name__, e)
         return False
 
 
@@ -755,31 +1089,41 @@ def build_response(event, response_data, status_code=200):
     
     Args:
         event: Evento original de Bedrock Agent
-        response_data: Dict con los datos de respuesta
+        response_data: Dict con los datos de respuesta, o str JSON ya serializado
         status_code: HTTP status code (default: 200)
     
     Returns:
         dict en formato Bedrock Agent
     """
-    logger.info(f" Construyendo respuesta para Bedrock Agent:")
-    logger.info(f"  - Status Code: {status_code}")
-    logger.info(f"  - Action Group: {event.get('actionGroup', 'ValidarOTP')}")
-    logger.info(f"  - Response Body: {json.dumps(response_data, ensure_ascii=False)[:200]}...")
+    if isinstance(response_data, str):
+        body = response_data
+    else:
+        body = json.dumps(response_data, ensure_ascii=False)
+    
+    action_group = event.get('actionGroup', 'ValidarOTP')
+    logger.info(" Construyendo respuesta para Bedrock Agent: status=%s, actionGroup=%s",
+                status_code, action_group)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("  - Response Body: %s...", body[:200])
     
-    formatted_response = {
+    # Literal construido en una sola expresión: copiar y parchear una plantilla
+    # global asignaría los mismos dicts anidados y además arriesga mutarla
+    return {
         "messageVersion": "1.0",
         "response": {
-            "actionGroup": event.get('actionGroup', 'ValidarOTP'),
+            "actionGroup": action_group,
             "apiPath": event.get('apiPath', '/validar-otp'),
             "httpMethod": event.get('httpMethod', 'POST'),
             "httpStatusCode": status_code,
             "responseBody": {
                 "application/json": {
-                    "body": json.dumps(response_data, ensure_ascii=False)
+                    "body": body
                 }
             }
         }
     }
-    
-    logger.info("✅ Respuesta formateada correctamente")
-    return formatted_response
+
+
+# Solo dentro de Lambda (no en pruebas locales): el costo del primer llamado pasa a la fase INIT
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') in ('on-demand', 'provisioned-concurrency'):
+    _warmup()